@@ -1,33 +1,45 @@
+import atexit
 import logging
+import logging.handlers
+import json
 import os
-import random
-import requests
+import queue
+import re
+import secrets
+import sys
+from decimal import Decimal, ROUND_DOWN
+import time
+import weakref
+import httpx
 import asyncio
-from functools import wraps
+from collections import OrderedDict
+from functools import wraps, lru_cache
+from uuid import uuid4
 
-from requests.adapters import HTTPAdapter, Retry
+import redis.asyncio as aioredis
+
+# uvloop: 설치돼 있으면 기본 asyncio 이벤트 루프 대신 사용 (Windows 미지원 → 없으면 기본 루프)
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
 
 # telegram-bot
-from telegram import (
-    Update,
-    InlineKeyboardButton,
-    InlineKeyboardMarkup,
-    InputMediaDocument,
-    InputMediaPhoto
-)
+from telegram import Update
 from telegram.ext import (
+    AIORateLimiter,
+    Application,
     ApplicationBuilder,
     CommandHandler,
     MessageHandler,
     ConversationHandler,
     filters,
-    CallbackContext
+    CallbackContext,
+    BaseHandler
 )
-from telegram.constants import ParseMode
 
 # SQLAlchemy
 from sqlalchemy import (
-    create_engine,
     Column,
     Integer,
     String,
@@ -35,14 +47,29 @@ from sqlalchemy import (
     BigInteger,
     Text,
     TIMESTAMP,
-    text
+    Index,
+    text,
+    select,
+    insert,
+    update as sql_update,  # 핸들러 인자 update 와 이름 충돌 방지
+    delete,
+    or_,
+    func,
+    bindparam,
+    union_all
 )
 # SQLAlchemy 2.0 권장: sqlalchemy.orm.declarative_base 사용
-from sqlalchemy.orm import declarative_base, sessionmaker, scoped_session
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.pool import NullPool
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from sqlalchemy.orm import declarative_base, relationship, joinedload
 
 # Tronpy
-from tronpy import Tron
-from tronpy.providers import HTTPProvider
+from tronpy import AsyncTron
+from tronpy.async_tron import AsyncTransaction
+from tronpy.keys import PrivateKey
+from tronpy.providers.async_http import AsyncHTTPProvider
 
 # ==============================
 # 1) 환경변수 (Fly.io 시크릿 등)
@@ -54,38 +81,91 @@ TRON_WALLET = os.getenv("TRON_WALLET", "")
 PRIVATE_KEY = os.getenv("PRIVATE_KEY", "")
 TRON_PASSWORD = os.getenv("TRON_PASSWORD", "")  # 예시
 ADMIN_TELEGRAM_ID = int(os.getenv("ADMIN_TELEGRAM_ID", "999999999"))
+REDIS_URL = os.getenv("REDIS_URL", "")  # 설정 시 채팅 상태를 Redis 에 보관 (재시작/다중 워커 공유)
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")  # 예: "https://my-bot.fly.dev" (설정 시 Webhook, 없으면 Polling)
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+PORT = int(os.getenv("PORT", "8443"))
+INIT_SCHEMA = os.getenv("INIT_SCHEMA") == "1"  # 기동 시에도 스키마 생성 (배포는 release_command 의 init-schema 가 담당, 로컬 실행용)
 
 # TRC20 USDT
 USDT_CONTRACT = "TR7NHqjeKQxGTCi8q8ZY4pL8otSzgjLj6t"
 
 # ==============================
-# 2) requests 세션 (재시도 설정)
-http_session = requests.Session()
-retries = Retry(total=3, backoff_factor=1, status_forcelist=[500, 502, 503, 504])
-http_adapter = HTTPAdapter(max_retries=retries)
-http_session.mount("https://", http_adapter)
-http_session.mount("http://", http_adapter)
+# 2) TronGrid HTTP 클라이언트 (입금 조회 + tronpy 잔액/송금이 연결 풀 하나를 공유)
+# 비동기 클라이언트 → 핸들러에서 스레드 없이 바로 await (연결 재사용 / 연결 실패 시 재시도)
+# 이벤트 루프에 묶이므로 처음 사용할 때 생성
+TRON_API_CLEAN = TRON_API.rstrip("/")
+TRON_HTTP_TIMEOUT = 10  # 초
+TRON_HTTP_RETRIES = 3
+
+@lru_cache(maxsize=1)
+def get_tron_http() -> httpx.AsyncClient:
+    headers = {"Accept": "application/json"}
+    if TRON_API_KEY:
+        headers["TRON-PRO-API-KEY"] = TRON_API_KEY
+    return httpx.AsyncClient(
+        base_url=TRON_API_CLEAN,
+        headers=headers,
+        timeout=TRON_HTTP_TIMEOUT,
+        transport=httpx.AsyncHTTPTransport(retries=TRON_HTTP_RETRIES),
+    )
 
 # ==============================
-# 3) SQLAlchemy 설정
-engine = create_engine(
-    DATABASE_URL,
-    echo=True,  # 콘솔 로그
-    connect_args={"options": "-c timezone=utc"},
-    future=True,
-    pool_pre_ping=True,
-)
-SessionLocal = scoped_session(sessionmaker(autocommit=False, autoflush=False, bind=engine))
+# 3) SQLAlchemy 설정 (asyncpg 비동기 엔진: DB 대기 중에도 이벤트 루프가 다른 업데이트 처리)
+# 연결 풀: 핸들러마다 세션을 열고 닫으면 연결은 풀로 반환되어 재사용됨
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "20"))
+DB_POOL_RECYCLE = 1800  # 초
+# asyncpg 는 연결마다 PREPARE 한 문장을 캐시해 재사용 (파싱/플랜 생략)
+# 쿼리는 모두 모듈 상수라 종류가 적으므로 기본 100 이면 충분
+DB_STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", "100"))
+# PgBouncer 등 외부 풀러를 쓸 때는 DB_NULL_POOL=1 → 앱 쪽 풀 없이 풀러에 맡김 (이중 풀링 방지)
+# transaction 모드 풀러는 문장마다 서버 연결이 바뀔 수 있음: SQLAlchemy asyncpg 는 캐시 0 이어도 항상
+# 이름 있는 PREPARE(__asyncpg_stmt_N__)를 쓰므로 연결 간 이름 충돌 → 캐시 0 + 문장마다 uuid 이름
+DB_NULL_POOL = os.getenv("DB_NULL_POOL") == "1"
+
+# 엔진은 처음 쓸 때 한 번만 생성 (import 시 DATABASE_URL 파싱/엔진 생성 없음)
+@lru_cache(maxsize=1)
+def get_engine():
+    db_url = make_url(DATABASE_URL).set(drivername="postgresql+asyncpg")
+    if "sslmode" in db_url.query:  # asyncpg 는 sslmode 대신 ssl 인자 사용
+        db_url = db_url.difference_update_query(["sslmode"]).update_query_dict({"ssl": db_url.query["sslmode"]})
+    connect_args = {"server_settings": {"timezone": "utc"}}
+    if DB_NULL_POOL:
+        db_url = db_url.update_query_dict({"prepared_statement_cache_size": "0"})
+        connect_args["prepared_statement_name_func"] = lambda: f"__asyncpg_{uuid4()}__"
+        pool_options = {"poolclass": NullPool}
+    else:
+        db_url = db_url.update_query_dict({"prepared_statement_cache_size": str(DB_STATEMENT_CACHE_SIZE)})
+        pool_options = {
+            "pool_size": DB_POOL_SIZE,
+            "max_overflow": DB_MAX_OVERFLOW,
+            "pool_pre_ping": True,
+            "pool_recycle": DB_POOL_RECYCLE,
+        }
+    return create_async_engine(
+        db_url,
+        echo=os.getenv("SQL_ECHO") == "1",  # SQL 콘솔 로그는 필요할 때만
+        connect_args=connect_args,
+        **pool_options,
+    )
+
+# commit 후에도 로드한 값을 그대로 쓰도록 expire_on_commit=False (만료 후 지연 로딩은 async 에서 불가)
+@lru_cache(maxsize=1)
+def get_session_factory():
+    return async_sessionmaker(get_engine(), autoflush=False, expire_on_commit=False)
+
 Base = declarative_base()
 
+# 핸들러 호출마다 독립된 세션 (동시에 처리되는 업데이트끼리 세션을 공유하지 않음)
 def get_db_session():
-    return SessionLocal()
+    return get_session_factory()()
 
 # ==============================
 # 4) DB 모델
 class Item(Base):
     __tablename__ = "items"
-    id = Column(Integer, primary_key=True, index=True)
+    id = Column(Integer, primary_key=True)
     name = Column(Text, nullable=False)
     price = Column(DECIMAL, nullable=False)
     seller_id = Column(BigInteger, nullable=False)
@@ -93,9 +173,19 @@ class Item(Base):
     type = Column(String, nullable=False)
     created_at = Column(TIMESTAMP, server_default=text("CURRENT_TIMESTAMP"))
 
+    __table_args__ = (
+        Index("ix_item_status_id", "status", "id"),               # /list 페이지
+        Index("ix_item_seller_status", "seller_id", "status"),    # /cancel 목록
+    )
+
+# /search, /offer 이름 검색 (ILIKE '%검색어%') → pg_trgm GIN (확장을 쓸 수 없으면 생략)
+ITEM_NAME_TRGM_INDEX = Index(
+    "ix_item_name_trgm", Item.name, postgresql_using="gin", postgresql_ops={"name": "gin_trgm_ops"}
+)
+
 class Transaction(Base):
     __tablename__ = "transactions"
-    id = Column(Integer, primary_key=True, index=True)
+    id = Column(Integer, primary_key=True)
     item_id = Column(Integer, nullable=False)
     buyer_id = Column(BigInteger, nullable=False)
     seller_id = Column(BigInteger, nullable=False)
@@ -105,116 +195,347 @@ class Transaction(Base):
     amount = Column(DECIMAL, nullable=False)
     created_at = Column(TIMESTAMP, server_default=text("CURRENT_TIMESTAMP"))
 
+    # 거래 조회는 모두 transaction_id(unique 인덱스) 로 시작하므로 별도 인덱스 없음
+
+    # DB FK 없이 item_id 로 연결 (상품 삭제 시에도 거래 기록 유지)
+    item = relationship("Item", primaryjoin="foreign(Transaction.item_id) == Item.id", viewonly=True)
+
 class Rating(Base):
     __tablename__ = "ratings"
-    id = Column(Integer, primary_key=True, index=True)
+    id = Column(Integer, primary_key=True)
     user_id = Column(BigInteger, nullable=False)
     score = Column(Integer, nullable=False)
     review = Column(Text)
     created_at = Column(TIMESTAMP, server_default=text("CURRENT_TIMESTAMP"))
 
-# 테이블 생성
-Base.metadata.create_all(bind=engine)
+# 쿼리 조건에 쓰이지 않는 인덱스 (PK 와 중복되는 id 인덱스 등) → 쓰기마다 갱신 비용만 들어 제거
+OBSOLETE_INDEXES = ("ix_items_id", "ix_transactions_id", "ix_ratings_id")
+
+# 테이블 생성 + 기존 테이블에도 새 인덱스 반영 (이미 있으면 건너뜀)
+def create_schema(conn):
+    try:
+        with conn.begin_nested():
+            conn.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+    except Exception as e:
+        logging.warning("pg_trgm 확장 사용 불가, 이름 검색 인덱스 생략: %s", e)
+        Item.__table__.indexes.discard(ITEM_NAME_TRGM_INDEX)
+    Base.metadata.create_all(bind=conn)
+    for name in OBSOLETE_INDEXES:
+        conn.execute(text(f"DROP INDEX IF EXISTS {name}"))
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(conn, checkfirst=True)
+
+# init-schema 와 INIT_SCHEMA=1 기동이 여러 인스턴스에서 겹쳐도 DDL 은 한 번에 하나만 (트랜잭션 종료 시 잠금 자동 해제)
+# 뒤에 잠금을 얻은 인스턴스는 checkfirst 로 이미 만들어진 테이블/인덱스를 건너뜀
+SCHEMA_LOCK_KEY = 0x65736372  # 임의의 고정값 (pg_advisory_xact_lock 키)
+
+async def init_schema():
+    async with get_engine().begin() as conn:
+        await conn.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": SCHEMA_LOCK_KEY})
+        await conn.run_sync(create_schema)
+
+# 목록/검색 쿼리 (모듈 로드 시 한 번만 구성, 값은 bindparam 으로 전달)
+# 목록 화면은 번호/이름/가격/종류만 쓰므로 해당 컬럼만 조회
+ITEM_LIST_COLUMNS = (Item.id, Item.name, Item.price, Item.type)
+AVAILABLE_ITEMS = select(*ITEM_LIST_COLUMNS).where(Item.status == "available").order_by(Item.id)
+SELLER_AVAILABLE_ITEMS = (
+    select(*ITEM_LIST_COLUMNS)
+    .where(Item.seller_id == bindparam("seller_id"), Item.status == "available")
+    .order_by(Item.id)
+)
+SEARCH_AVAILABLE_ITEMS = (
+    select(*ITEM_LIST_COLUMNS)
+    .where(Item.name.ilike(bindparam("pattern")), Item.status == "available")
+    .order_by(Item.id)
+)
+# /offer 는 상품 ID 만 있으면 되므로 ID 컬럼만 조회 (INSERT ... SELECT 가 나머지를 채움)
+FIND_AVAILABLE_ITEM_ID_BY_NAME = (
+    select(Item.id)
+    .where(Item.name.ilike(bindparam("pattern")), Item.status == "available")
+    .order_by(Item.id)
+    .limit(1)
+)
+FIND_SELLER_ITEM_ID_BY_NAME = (
+    select(Item.id)
+    .where(
+        Item.name.ilike(bindparam("pattern")),
+        Item.seller_id == bindparam("seller_id"),
+        Item.status == "available",
+    )
+    .order_by(Item.id)
+    .limit(1)
+)
+# 숫자 입력: 상품 ID(PK) 로 먼저, 없으면 이름으로 → UNION ALL 한 번의 왕복
+# (PK 분기가 먼저 실행되고 LIMIT 1 에서 멈추므로 이름 검색은 ID 가 없을 때만 수행)
+FIND_AVAILABLE_ITEM_ID_BY_ID = select(Item.id).where(Item.id == bindparam("item_id"), Item.status == "available")
+FIND_SELLER_ITEM_ID_BY_ID = select(Item.id).where(
+    Item.id == bindparam("item_id"),
+    Item.seller_id == bindparam("seller_id"),
+    Item.status == "available",
+)
+FIND_AVAILABLE_ITEM_ID_BY_ID_OR_NAME = union_all(FIND_AVAILABLE_ITEM_ID_BY_ID, FIND_AVAILABLE_ITEM_ID_BY_NAME).limit(1)
+FIND_SELLER_ITEM_ID_BY_ID_OR_NAME = union_all(FIND_SELLER_ITEM_ID_BY_ID, FIND_SELLER_ITEM_ID_BY_NAME).limit(1)
+
+# /cancel: 찾기 + 삭제를 DELETE ... RETURNING 한 문장으로 (판매 중인 본인 상품만, 그 사이 팔렸으면 삭제 안 됨)
+def cancel_item_statement(find_item_id):
+    return (
+        delete(Item)
+        .where(
+            Item.id == find_item_id.scalar_subquery(),
+            Item.seller_id == bindparam("seller_id"),
+            Item.status == "available",
+        )
+        .returning(Item.name)
+        .execution_options(synchronize_session=False)
+    )
+
+CANCEL_SELLER_ITEM_BY_ID = cancel_item_statement(FIND_SELLER_ITEM_ID_BY_ID)
+CANCEL_SELLER_ITEM_BY_NAME = cancel_item_statement(FIND_SELLER_ITEM_ID_BY_NAME)
+CANCEL_SELLER_ITEM_BY_ID_OR_NAME = cancel_item_statement(FIND_SELLER_ITEM_ID_BY_ID_OR_NAME)
+
+# /sell 등록: 새 상품 ID 를 INSERT ... RETURNING 으로 같은 왕복에서 받아 안내 (바로 /offer 번호 로 사용 가능)
+INSERT_ITEM = insert(Item).returning(Item.id)
+
+# 거래 조회 쿼리 (거래 ID + 상태로 찾는 문장들도 모듈 로드 시 한 번만 구성)
+FIND_TRANSACTION = select(Transaction).where(Transaction.transaction_id == bindparam("t_id"))
+FIND_TRANSACTION_BY_STATUS = FIND_TRANSACTION.where(Transaction.status == bindparam("status"))
+FIND_TRANSACTION_WITH_ITEM = FIND_TRANSACTION_BY_STATUS.options(joinedload(Transaction.item))  # 상품도 JOIN 한 번으로
+TRANSACTION_ID_BY_STATUS = select(Transaction.id).where(
+    Transaction.transaction_id == bindparam("t_id"),
+    Transaction.status == bindparam("status"),
+)
+TRANSACTION_STATUS = select(Transaction.status).where(Transaction.transaction_id == bindparam("t_id"))
+# 아래 쓰기 문장은 RETURNING 서브쿼리/CTE 를 쓰므로 ORM 이 아닌 테이블 기준 Core 문장으로 작성
+transactions_table, items_table = Transaction.__table__, Item.__table__
+# /offer: 판매 중인 상품에서 바로 거래 생성 (상품 확인과 INSERT 를 한 문장으로 → 그 사이 취소돼도 안전)
+# 알림에 쓸 판매자/상품 이름은 같은 CTE 에서 함께 반환
+offer_source = (
+    select(items_table.c.id, items_table.c.seller_id, items_table.c.price, items_table.c.name)
+    .where(items_table.c.id == bindparam("item_id"), items_table.c.status == "available")
+    .cte("offer_source")
+)
+offer_insert = (
+    insert(transactions_table)
+    .from_select(
+        ["item_id", "buyer_id", "seller_id", "amount", "transaction_id"],
+        select(
+            offer_source.c.id,
+            bindparam("buyer", type_=BigInteger),
+            offer_source.c.seller_id,
+            offer_source.c.price,
+            bindparam("t_id", type_=Text),
+        ),
+    )
+    .returning(transactions_table.c.item_id)
+    .cte("offer_insert")
+)
+OFFER_ITEM = select(offer_source.c.seller_id, offer_source.c.name).join_from(
+    offer_insert, offer_source, offer_source.c.id == offer_insert.c.item_id
+)
+# /confirm: 거래 완료 + 상품 판매완료 처리를 한 문장으로 (데이터 변경 CTE 는 참조와 무관하게 항상 실행)
+completed_transaction = (
+    sql_update(transactions_table)
+    .where(
+        transactions_table.c.transaction_id == bindparam("t_id"),
+        transactions_table.c.status == "deposit_confirmed",
+        transactions_table.c.buyer_id == bindparam("buyer"),
+    )
+    .values(status="completed")
+    .returning(transactions_table.c.item_id)
+    .cte("completed_transaction")
+)
+sold_item = (
+    sql_update(items_table)
+    .where(
+        items_table.c.id.in_(select(completed_transaction.c.item_id)),
+        items_table.c.status == "available",
+    )
+    .values(status="sold")
+    .returning(items_table.c.id)
+    .cte("sold_item")
+)
+COMPLETE_TRANSACTION = select(completed_transaction.c.item_id).add_cte(sold_item)
+# /accept: 상태 변경 + 알림에 쓸 상품 이름을 UPDATE ... RETURNING 한 문장으로
+ACCEPT_TRANSACTION = (
+    sql_update(transactions_table)
+    .where(
+        transactions_table.c.transaction_id == bindparam("t_id"),
+        transactions_table.c.status == "pending",
+        transactions_table.c.seller_id == bindparam("seller"),
+    )
+    .values(session_id=bindparam("seller_wallet"), status="accepted")
+    .returning(
+        transactions_table.c.buyer_id,
+        transactions_table.c.amount,
+        transactions_table.c.item_id,
+        select(items_table.c.name).where(items_table.c.id == transactions_table.c.item_id).scalar_subquery(),
+    )
+)
 
 # ==============================
 # 5) Tron 설정
-TRON_API_CLEAN = TRON_API.rstrip("/")
-client = Tron(provider=HTTPProvider(TRON_API_CLEAN, api_key=TRON_API_KEY))
-
-NORMAL_COMMISSION_RATE = 0.05
-OVERSEND_COMMISSION_RATE = 0.075
+# tronpy 비동기 클라이언트: 위 httpx 클라이언트(API 키 헤더 포함)로 요청
+@lru_cache(maxsize=1)
+def get_tron() -> AsyncTron:
+    return AsyncTron(provider=AsyncHTTPProvider(TRON_API_CLEAN, client=get_tron_http()))
+
+# USDT(TRC20) 는 소수점 6자리: 금액은 Decimal 로 계산하고 전송 시 최소단위 정수로 변환 (float 오차 방지)
+USDT_DECIMAL_PLACES = 6
+USDT_DECIMALS = 10**USDT_DECIMAL_PLACES
+TRON_FEE_LIMIT = 1_000_000_000  # sun (1000 TRX)
+USDT_UNIT = Decimal(1).scaleb(-USDT_DECIMAL_PLACES)  # 0.000001
+# 상품 가격 입력: 숫자, 소수점 이하 최대 6자리
+PRICE_PATTERN = re.compile(r"[0-9]+(?:\.[0-9]{1,6})?")
+# /offer, /cancel 의 상품 번호 입력: ASCII 숫자 9자리까지 (str.isdigit 은 '²' 같은 문자도 통과시켜 int() 에서 예외,
+# 10자리 이상은 INTEGER 범위를 넘어 DB 오류 → 이런 입력은 이름 검색으로 처리)
+ITEM_ID_PATTERN = re.compile(r"[0-9]{1,9}")
+# /rate 평점 입력: 1~5 한 자리
+RATING_PATTERN = re.compile(r"[1-5]")
+
+NORMAL_COMMISSION_RATE = Decimal("0.05")
+NORMAL_PAYOUT_RATE = 1 - NORMAL_COMMISSION_RATE  # 판매자 수령 비율 (0.95)
+OVERSEND_COMMISSION_RATE = Decimal("0.075")
+REFUND_RATE = Decimal("0.975")  # 예: 환불 수수료 2.5%
+
+def to_usdt_units(amount) -> int:
+    return int((Decimal(str(amount)) * USDT_DECIMALS).to_integral_value(rounding=ROUND_DOWN))
+
+# 온체인 최소단위 정수 → USDT: 나눗셈 대신 지수만 옮김 (항상 정확, 반올림 없음)
+def from_usdt_units(units: int) -> Decimal:
+    return Decimal(units).scaleb(-USDT_DECIMAL_PLACES)
+
+# 수수료 계산 결과는 전송 가능한 6자리로 내림
+def usdt_amount(amount: Decimal) -> Decimal:
+    return amount.quantize(USDT_UNIT, rounding=ROUND_DOWN)
+
+# 표시용: 불필요한 0 제거 (9.500000 → 9.5)
+def format_usdt(amount: Decimal) -> str:
+    return f"{Decimal(amount).normalize():f}"
+
+# 거래 ID: 12자리 숫자 (사용자가 직접 입력하므로 숫자 유지)
+TRANSACTION_ID_RETRIES = 3
+TRANSACTION_ID_SPACE = 10**12
+
+def generate_transaction_id() -> str:
+    return f"{secrets.randbelow(TRANSACTION_ID_SPACE):012d}"
+
+# /off 로 중단할 수 있는 거래 상태
+CANCELLABLE_STATUSES = ("pending", "accepted", "deposit_confirmed", "deposit_confirmed_over")
+# /chat 을 열 수 있는 거래 상태
+CHAT_STATUSES = ("accepted", "deposit_confirmed", "deposit_confirmed_over", "completed")
+CHAT_PARTICIPANTS = select(Transaction.buyer_id, Transaction.seller_id).where(
+    Transaction.transaction_id == bindparam("t_id"),
+    Transaction.status.in_(CHAT_STATUSES),
+)
 
 # ==============================
-# 6) Webhook 해제 → Polling 사용 (getUpdates 방식)
-def remove_webhook(token: str):
-    try:
-        resp = requests.get(f"https://api.telegram.org/bot{token}/deleteWebhook?drop_pending_updates=true", timeout=10)
-        logging.info(f"deleteWebhook response: {resp.status_code}, {resp.text}")
-    except Exception as e:
-        logging.error(f"deleteWebhook error: {e}")
+# 6) 업데이트 수신: WEBHOOK_URL 이 있으면 Webhook, 없으면 Webhook 해제 후 Polling (getUpdates 방식)
+# 봇은 메시지만 처리하므로 다른 종류의 업데이트는 받지 않음
+ALLOWED_UPDATES = [Update.MESSAGE]
+# 롱폴링: 새 업데이트가 없으면 Telegram 이 최대 30초 응답을 붙잡고 있음 (빈 getUpdates 반복 방지)
+# (PTB 가 getUpdates 읽기 타임아웃에 이 값을 더해 줌)
+POLL_TIMEOUT = 30
 
 # ==============================
 # 7) Tron 유틸 (거래조회, 송금)
-def fetch_transaction_detail(txid: str) -> dict:
+# USDT 컨트랙트(ABI)는 바뀌지 않으므로 처음 한 번만 조회
+usdt_contract = None
+
+async def get_usdt_contract():
+    global usdt_contract
+    if usdt_contract is None:
+        usdt_contract = await get_tron().get_contract(USDT_CONTRACT)
+    return usdt_contract
+
+async def fetch_transaction_detail(txid: str) -> dict:
     try:
-        url = f"{TRON_API_CLEAN}/v1/transactions/{txid}"
-        headers = {"Accept": "application/json"}
-        if TRON_API_KEY:
-            headers["TRON-PRO-API-KEY"] = TRON_API_KEY
-        resp = http_session.get(url, headers=headers, timeout=10)
+        resp = await get_tron_http().get(f"/v1/transactions/{txid}")
         resp.raise_for_status()
         data = resp.json().get("data", [])
         return data[0] if data else {}
     except Exception as e:
-        logging.error(f"fetch_transaction_detail 오류: {e}")
+        logging.error("fetch_transaction_detail 오류: %s", e)
         return {}
 
-def parse_trc20_transfer_amount_and_memo(tx_detail: dict) -> (float, str):
+def parse_trc20_transfer_amount_and_memo(tx_detail: dict) -> (int, str):
+    # (최소단위 금액, 메모)
     try:
         contracts = tx_detail.get("raw_data", {}).get("contract", [])
         if not contracts:
-            return 0.0, ""
+            return 0, ""
         first_contract = contracts[0].get("parameter", {}).get("value", {})
-        transferred_amount = first_contract.get("amount", 0)
+        transferred_units = int(first_contract.get("amount", 0))
         data_hex = first_contract.get("data", "")
         memo = bytes.fromhex(data_hex).decode("utf-8") if data_hex else ""
-        actual_amount = transferred_amount / 1e6
-        return actual_amount, memo
+        return transferred_units, memo
     except Exception as e:
-        logging.error(f"parse_trc20_transfer_amount_and_memo 오류: {e}")
-        return 0.0, ""
+        logging.error("parse_trc20_transfer_amount_and_memo 오류: %s", e)
+        return 0, ""
 
-def verify_deposit(expected_amount: float, txid: str, internal_txid: str) -> (bool, float):
+async def verify_deposit(expected_amount: Decimal, txid: str, internal_txid: str) -> (bool, Decimal):
     try:
-        detail = fetch_transaction_detail(txid)
-        actual_amount, memo = parse_trc20_transfer_amount_and_memo(detail)
-        if abs(actual_amount - expected_amount) > 1e-6:
+        detail = await fetch_transaction_detail(txid)
+        transferred_units, memo = parse_trc20_transfer_amount_and_memo(detail)
+        actual_amount = from_usdt_units(transferred_units)
+        if transferred_units != to_usdt_units(expected_amount):
             return (False, actual_amount)
         if internal_txid.lower() not in memo.lower():
             return (False, actual_amount)
         return (True, actual_amount)
     except Exception as e:
-        logging.error(f"verify_deposit 오류: {e}")
-        return (False, 0)
+        logging.error("verify_deposit 오류: %s", e)
+        return (False, Decimal(0))
 
-def check_usdt_payment(expected_amount: float, txid: str = "", internal_txid: str = "") -> (bool, float):
-    if txid and internal_txid:
-        return verify_deposit(expected_amount, txid, internal_txid)
-    try:
-        contract = client.get_contract(USDT_CONTRACT)
-        balance = contract.functions.balanceOf(TRON_WALLET)
-        actual = balance / 1e6
-        return (actual >= expected_amount, actual)
-    except Exception as e:
-        logging.error(f"check_usdt_payment 오류: {e}")
-        return (False, 0)
+# 서명 키는 처음 송금할 때 한 번만 파싱
+@lru_cache(maxsize=1)
+def get_private_key() -> PrivateKey:
+    return PrivateKey(bytes.fromhex(PRIVATE_KEY))
 
-def send_usdt(to_address: str, amount: float, memo: str = "") -> dict:
+# 빌드·서명까지만 (네트워크 전송 전) → 여기서 실패하면 송금은 절대 일어나지 않음
+async def sign_usdt_transfer(to_address: str, amount: Decimal, memo: str = "") -> AsyncTransaction:
     if not TRON_PASSWORD:
         logging.warning("TRON_PASSWORD가 설정되지 않음(예시)")
+    contract = await get_usdt_contract()
+    builder = (
+        (await contract.functions.transfer(to_address, to_usdt_units(amount)))
+        .with_owner(TRON_WALLET)
+        .fee_limit(TRON_FEE_LIMIT)
+    )
+    if memo:
+        builder = builder.memo(memo)
+    return (await builder.build()).sign(get_private_key())
+
+# 노드 응답 없이 끊긴 브로드캐스트 → 이미 전파됐을 수 있음 (연결 자체가 안 된 경우만 미전송 확실)
+def broadcast_outcome_unknown(e: Exception) -> bool:
+    return isinstance(e, httpx.HTTPError) and not isinstance(e, (httpx.ConnectError, httpx.ConnectTimeout))
+
+# 블록 포함 대기(txn.wait)도 asyncio.sleep 으로 폴링 → 송금 중에도 다른 업데이트 처리
+async def send_usdt(to_address: str, amount: Decimal, memo: str = "") -> dict:
     try:
-        contract = client.get_contract(USDT_CONTRACT)
-        data = memo.encode("utf-8").hex() if memo else ""
-        txn = (
-            contract.functions.transfer(to_address, int(amount * 1e6))
-            .with_owner(TRON_WALLET)
-            .fee_limit(1_000_000_000)
-            .with_data(data)
-            .build()
-            .sign(PRIVATE_KEY)
-            .broadcast()
-        )
-        result = txn.wait()
-        return result
+        txn = await (await sign_usdt_transfer(to_address, amount, memo)).broadcast()
+        return await txn.wait()
     except Exception as e:
-        logging.error(f"TRC20 송금 오류: {e}")
+        logging.error("TRC20 송금 오류: %s", e, exc_info=True)
         raise
 
 # ==============================
 # (자동 입금 확인 기능은 제거되었습니다. 수동으로 /checkdeposit 명령어를 사용하세요.)
 # ==============================
 # 8) 로깅 설정
-logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO)
+# 로그 호출은 큐에 넣기만 하고 stderr 쓰기는 별도 스레드(QueueListener)가 담당 → 이벤트 루프가 출력 I/O 를 기다리지 않음
+# (종료 시 atexit 에서 남은 로그를 모두 출력)
+log_queue = queue.SimpleQueue()
+log_stream_handler = logging.StreamHandler()
+log_stream_handler.setFormatter(logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s"))
+log_listener = logging.handlers.QueueListener(log_queue, log_stream_handler)
+log_queue_handler = logging.handlers.QueueHandler(log_queue)
+log_queue_handler.setFormatter(logging.Formatter("%(message)s"))  # 메시지(+예외)만 합치고 나머지 형식은 출력 스레드에서
+logging.basicConfig(level=logging.INFO, handlers=[log_queue_handler])
+log_listener.start()
+atexit.register(log_listener.stop)
+# httpx 는 Bot API 요청(getUpdates 롱폴링 포함)마다 INFO 로그를 남김 → 경고 이상만 기록
+logging.getLogger("httpx").setLevel(logging.WARNING)
 
 # 대화 상태 상수
 (WAITING_FOR_ITEM_NAME,
@@ -224,13 +545,124 @@ logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s
  WAITING_FOR_RATING,
  WAITING_FOR_CONFIRMATION,
  WAITING_FOR_REFUND_WALLET) = range(7)
+# 대화 상태에서 받는 일반 텍스트 입력 (모든 ConversationHandler 가 필터 객체 하나를 공유)
+TEXT_INPUT = filters.TEXT & ~filters.COMMAND
 
 ITEMS_PER_PAGE = 10
-active_chats = {}
+
+# Telegram 전송 한도(봇 전체 30 msg/s)보다 약간 낮게 유지
+TELEGRAM_MAX_RATE = 28
+TELEGRAM_MAX_RETRIES = 3
 
 BANNED_USERS = set()  # 차단된 사용자 ID 모음
 REGISTERED_USERS = set()
 
+# ==============================
+# 채팅 상태: REDIS_URL 이 있으면 Redis, 없으면 프로세스 메모리
+#   Redis 키: chat:{거래ID} → {buyer, seller} 해시, chat_user:{사용자ID} → "거래ID:상대방ID"
+CHAT_TTL = 86400  # 초 (하루 동안 메시지 없으면 채팅 만료)
+redis_client = aioredis.from_url(REDIS_URL, decode_responses=True) if REDIS_URL else None
+
+active_chats = {}   # 거래 ID → (구매자 ID, 판매자 ID)
+user_to_partner = {}   # 사용자 ID → (거래 ID, 상대방 ID) (active_chats 역인덱스)
+
+# 라우팅은 호출한 사용자 것만 설정 → 상대방이 다른 거래 채팅 중이어도 가로채지 않음 (상대방은 직접 /chat)
+async def open_chat(t_id: str, user_id: int, buyer_id: int, seller_id: int) -> None:
+    partner_id = seller_id if user_id == buyer_id else buyer_id
+    if redis_client:
+        async with redis_client.pipeline(transaction=True) as pipe:
+            pipe.hset(f"chat:{t_id}", mapping={"buyer": buyer_id, "seller": seller_id})
+            pipe.expire(f"chat:{t_id}", CHAT_TTL)
+            pipe.set(f"chat_user:{user_id}", f"{t_id}:{partner_id}", ex=CHAT_TTL)
+            await pipe.execute()
+        return
+    active_chats[t_id] = (buyer_id, seller_id)
+    user_to_partner[user_id] = (t_id, partner_id)
+
+async def close_chat(t_id: str) -> None:
+    if redis_client:
+        parties = await redis_client.hgetall(f"chat:{t_id}")
+        await redis_client.delete(f"chat:{t_id}")
+        for user_id in parties.values():
+            entry = await redis_client.get(f"chat_user:{user_id}")
+            if entry and entry.split(":", 1)[0] == t_id:
+                await redis_client.delete(f"chat_user:{user_id}")
+        return
+    parties = active_chats.pop(t_id, None)
+    if not parties:
+        return
+    for user_id in parties:
+        entry = user_to_partner.get(user_id)
+        if entry and entry[0] == t_id:
+            user_to_partner.pop(user_id)
+
+async def get_chat_partner(user_id: int):
+    # (거래 ID, 상대방 ID) 또는 None
+    if redis_client:
+        entry = await redis_client.get(f"chat_user:{user_id}")
+        if not entry:
+            return None
+        t_id, partner = entry.split(":", 1)
+        return t_id, int(partner)
+    return user_to_partner.get(user_id)
+
+# ==============================
+# 알림 전송 큐: 상대방 알림/공지는 큐에 넣고 바로 반환, 워커가 순서대로 전송
+# (전송 속도는 Application 의 AIORateLimiter 가 제한)
+NOTIFY_WORKERS = 4
+notify_queue = asyncio.Queue()  # (chat_id, text)
+notify_tasks = []
+
+def notify(chat_id: int, text: str) -> None:
+    notify_queue.put_nowait((chat_id, text))
+
+async def notification_worker(bot) -> None:
+    while True:
+        chat_id, text = await notify_queue.get()
+        try:
+            await bot.send_message(chat_id=chat_id, text=text)
+        except Exception as e:
+            logging.error("알림 전송 오류(유저 %s): %s", chat_id, e)
+        finally:
+            notify_queue.task_done()
+
+# 채팅 중인 사용자의 메시지만 통과 (그 외 메시지는 relay_message 를 호출하지 않음)
+# Redis 사용 시 필터에서 조회할 수 없으므로 relay_message 안에서 확인
+class InActiveChat(filters.MessageFilter):
+    def filter(self, message) -> bool:
+        return bool(message.from_user) and (redis_client is not None or message.from_user.id in user_to_partner)
+
+# ==============================
+# 명령어 디스패처
+# 단순 "/명령어" 들은 핸들러 하나에서 dict 조회로 분기 (CommandHandler 를 하나씩 검사하지 않음)
+# 여기 없는 명령어(/sell, /cancel 등 ConversationHandler 진입점)는 다음 핸들러로 넘어감
+class CommandDispatcherHandler(BaseHandler):
+    __slots__ = ("commands",)
+
+    def __init__(self, commands):
+        # 실제 호출할 콜백은 check_update 결과로 정해지므로 기본 callback 은 사용하지 않음
+        super().__init__(None)
+        self.commands = {name.lower(): fn for name, fn in commands.items()}
+
+    def check_update(self, update):
+        if not isinstance(update, Update) or not update.message:
+            return None
+        text = update.message.text
+        if not text or text[:1] != "/":
+            return None
+        command, _, target = text.split(None, 1)[0][1:].partition("@")
+        # 다른 봇을 지정한 명령어(/list@other_bot)는 무시
+        if target and target.lower() != (update.message.get_bot().username or "").lower():
+            return None
+        return self.commands.get(command.lower())
+
+    def collect_additional_context(self, context, update, application, check_result):
+        context.args = update.message.text.split()[1:]
+
+    async def handle_update(self, update, application, check_result, context):
+        self.collect_additional_context(context, update, application, check_result)
+        return await check_result(update, context)
+
 # ==============================
 # ban 데코레이터
 def check_banned(func):
@@ -242,54 +674,87 @@ def check_banned(func):
         return await func(update, context, *args, **kwargs)
     return wrapper
 
-@check_banned
+# 모든 메시지에서 실행되는 등록 핸들러 (group=-1 에 등록, 차단 여부는 실제 명령 핸들러가 확인)
 async def register_user(update: Update, context: CallbackContext) -> None:
     if update.effective_user:
         REGISTERED_USERS.add(update.effective_user.id)
 
 # ==============================
-# 명령어 안내
-def command_guide() -> str:
-    return (
-        "\n\n사용 가능한 명령어:\n"
-        "/sell - 상품 판매 등록\n"
-        "/list - 구매 가능한 상품 목록\n"
-        "/cancel - 본인이 등록한 상품 취소 (입금 전)\n"
-        "/search - 상품 검색\n"
-        "/offer - 거래 요청 (목록/검색 후)\n"
-        "/accept - 거래 요청 수락 (판매자)\n"
-        "/refusal - 거래 요청 거절 (판매자)\n"
-        "/checkdeposit - 입금 확인 (구매자)\n"
-        "/confirm - 거래 완료 확인 (구매자)\n"
-        "/refund - 환불 요청 (구매자)\n"
-        "/rate - 거래 종료 후 평점\n"
-        "/chat - 거래 당사자 간 채팅\n"
-        "/off - 거래 중단\n"
-        "/warexit - 거래 강제 종료 (관리자)\n"
-        "/adminsearch - 거래 검색 (관리자)\n"
-        "/post - 전체공지 (관리자)\n"
-        "/ban - 사용자 차단 (관리자)\n"
-        "/unban - 사용자 차단 해제 (관리자)\n"
-        "/exit - 대화 종료"
-    )
+# 명령어 안내 (응답마다 다시 만들지 않도록 모듈 상수로 한 번만 생성)
+COMMAND_GUIDE = (
+    "\n\n사용 가능한 명령어:\n"
+    "/sell - 상품 판매 등록\n"
+    "/list - 구매 가능한 상품 목록\n"
+    "/cancel - 본인이 등록한 상품 취소 (입금 전)\n"
+    "/search - 상품 검색\n"
+    "/offer - 거래 요청 (목록/검색 후)\n"
+    "/accept - 거래 요청 수락 (판매자)\n"
+    "/refusal - 거래 요청 거절 (판매자)\n"
+    "/checkdeposit - 입금 확인 (구매자)\n"
+    "/confirm - 거래 완료 확인 (구매자)\n"
+    "/refund - 환불 요청 (구매자)\n"
+    "/rate - 거래 종료 후 평점\n"
+    "/chat - 거래 당사자 간 채팅\n"
+    "/off - 거래 중단\n"
+    "/warexit - 거래 강제 종료 (관리자)\n"
+    "/adminsearch - 거래 검색 (관리자)\n"
+    "/post - 전체공지 (관리자)\n"
+    "/ban - 사용자 차단 (관리자)\n"
+    "/unban - 사용자 차단 해제 (관리자)\n"
+    "/exit - 대화 종료"
+)
+WELCOME_MESSAGE = "에스크로 거래 봇에 오신 것을 환영합니다!" + COMMAND_GUIDE
+
+# ==============================
+# 거래 응답 템플릿 (str.format, 명령어 안내는 미리 붙여둠)
+OFFER_CREATED_TEMPLATE = "'{name}' 거래 요청 생성!\n거래 ID: {t_id}\n(송금 시 메모 필수)\n" + COMMAND_GUIDE
+OFFER_NOTICE_TEMPLATE = (
+    "상품 '{name}'에 거래 요청이 도착했습니다.\n거래 ID: {t_id}\n"
+    "판매자: /accept 거래ID 판매자지갑 /refusal 거래ID"
+)
+ACCEPTED_TEMPLATE = "거래 ID {t_id} 수락됨. 구매자에게 송금 안내.\n" + COMMAND_GUIDE
+ACCEPT_NOTICE_TEMPLATE = (
+    "거래 ID {t_id} ('{name}') 수락됨.\n"
+    "해당 금액({amount} USDT)를 {wallet} 로 송금할 때, 메모(거래ID:{t_id}) 기입 필수."
+)
+DEPOSIT_NOTICE_TEMPLATE = (
+    "거래 ID {t_id} ('{name}') 입금 확인됨.\n판매자: 물품 발송 후 /confirm 명령어로 거래 완료 처리하세요."
+)
+CONFIRMED_TEMPLATE = "입금 최종 확인({amount} USDT). 판매자에게 {net_amount} USDT 송금!\n" + COMMAND_GUIDE
+COMPLETED_NOTICE_TEMPLATE = (
+    "거래 ID {t_id} ('{name}') 완료.\n"
+    "{net_amount} USDT가 판매자 지갑({wallet})으로 송금됨.\n"
+    "송금 결과: {result}"
+)
+REFUND_WALLET_TEMPLATE = "환불 진행. 구매자 지갑 주소?\n(환불 금액: {amount} USDT)\n(취소: /exit)" + COMMAND_GUIDE
+REFUNDED_TEMPLATE = "환불 완료: {amount} USDT → {wallet}\n거래ID {t_id}\n결과: {result}\n" + COMMAND_GUIDE
+REFUND_UNCONFIRMED_TEMPLATE = (
+    "환불 송금이 전송되었으나 아직 확인되지 않았습니다: {amount} USDT → {wallet}\n"
+    "거래ID {t_id}\ntxid {txid}\n관리자가 확인 후 안내드립니다.\n" + COMMAND_GUIDE
+)
+REFUND_UNCONFIRMED_NOTICE = "[확인 필요] 거래 {t_id} 환불 송금 미확인 (구매자 {buyer_id}, {amount} USDT → {wallet})\ntxid {txid}"
+RATED_TEMPLATE = "평점 {score}점 등록!\n" + COMMAND_GUIDE
 
 # ==============================
 # /start
 @check_banned
 async def start_command(update: Update, context: CallbackContext) -> None:
-    await update.message.reply_text("에스크로 거래 봇에 오신 것을 환영합니다!" + command_guide())
+    await update.message.reply_text(WELCOME_MESSAGE)
 
 @check_banned
 async def exit_to_start(update: Update, context: CallbackContext) -> int:
     context.user_data.clear()
-    await update.message.reply_text("대화를 취소합니다. /start 로 다시 시작.\n" + command_guide())
+    await update.message.reply_text("대화를 취소합니다. /start 로 다시 시작.\n" + COMMAND_GUIDE)
     return ConversationHandler.END
 
+# 대화 중 /exit 또는 다른 명령어 → 대화 종료 (모든 ConversationHandler 공통)
+CONVERSATION_FALLBACKS = [CommandHandler("exit", exit_to_start), MessageHandler(filters.COMMAND, exit_to_start)]
+
 # ==============================
 # /sell (ConversationHandler)
 @check_banned
 async def sell_command(update: Update, context: CallbackContext) -> int:
-    await update.message.reply_text("판매할 상품 이름?\n(취소: /exit)" + command_guide())
+    await update.message.reply_text("판매할 상품 이름?\n(취소: /exit)" + COMMAND_GUIDE)
     return WAITING_FOR_ITEM_NAME
 
 @check_banned
@@ -297,21 +762,23 @@ async def set_item_name(update: Update, context: CallbackContext) -> int:
     if update.message.text.lower() in ["/exit", "exit"]:
         return await exit_to_start(update, context)
     context.user_data["item_name"] = update.message.text.strip()
-    await update.message.reply_text("상품 가격(USDT)을 숫자로 입력.\n(취소: /exit)" + command_guide())
+    await update.message.reply_text("상품 가격(USDT)을 숫자로 입력.\n(취소: /exit)" + COMMAND_GUIDE)
     return WAITING_FOR_PRICE
 
 @check_banned
 async def set_item_price(update: Update, context: CallbackContext) -> int:
     if update.message.text.lower() in ["/exit", "exit"]:
         return await exit_to_start(update, context)
-    try:
-        price = float(update.message.text.strip())
-        context.user_data["price"] = price
-        await update.message.reply_text("상품 종류? (디지털/현물)\n(취소: /exit)" + command_guide())
-        return WAITING_FOR_ITEM_TYPE
-    except ValueError:
-        await update.message.reply_text("숫자로 입력해주세요.\n(취소: /exit)" + command_guide())
+    price_text = update.message.text.strip()
+    # 형식 검사 한 번으로 지수 표기(1e3)·밑줄(1_000)·NaN/Infinity·USDT 최소 단위 미만 자릿수를 모두 거름
+    # (통과한 문자열만 Decimal 로 한 번 변환, 0 은 거부)
+    price = Decimal(price_text) if PRICE_PATTERN.fullmatch(price_text) else None
+    if not price:
+        await update.message.reply_text("숫자로 입력해주세요.\n(취소: /exit)" + COMMAND_GUIDE)
         return WAITING_FOR_PRICE
+    context.user_data["price"] = price
+    await update.message.reply_text("상품 종류? (디지털/현물)\n(취소: /exit)" + COMMAND_GUIDE)
+    return WAITING_FOR_ITEM_TYPE
 
 @check_banned
 async def set_item_type(update: Update, context: CallbackContext) -> int:
@@ -319,7 +786,7 @@ async def set_item_type(update: Update, context: CallbackContext) -> int:
         return await exit_to_start(update, context)
     itype = update.message.text.strip().lower()
     if itype not in ["디지털", "현물"]:
-        await update.message.reply_text("디지털/현물 중에 입력.\n(취소: /exit)" + command_guide())
+        await update.message.reply_text("디지털/현물 중에 입력.\n(취소: /exit)" + COMMAND_GUIDE)
         return WAITING_FOR_ITEM_TYPE
 
     name = context.user_data["item_name"]
@@ -328,66 +795,213 @@ async def set_item_type(update: Update, context: CallbackContext) -> int:
 
     session = get_db_session()
     try:
-        new_item = Item(name=name, price=price, seller_id=seller_id, type=itype)
-        session.add(new_item)
-        session.commit()
-        await update.message.reply_text(f"'{name}' 상품이 등록되었습니다.\n" + command_guide())
+        # ORM 객체 없이 INSERT 한 번 (상품 ID 는 RETURNING 으로 함께 받음)
+        item_id = await session.scalar(
+            INSERT_ITEM, {"name": name, "price": price, "seller_id": seller_id, "type": itype}
+        )
+        await session.commit()
+        await invalidate_item_pages()
+        await update.message.reply_text(f"'{name}' 상품이 등록되었습니다. (상품 번호: {item_id})\n" + COMMAND_GUIDE)
     except Exception as e:
-        session.rollback()
-        logging.error(f"상품 등록 오류: {e}")
-        await update.message.reply_text("상품 등록 중 오류 발생.\n" + command_guide())
+        await session.rollback()
+        logging.error("상품 등록 오류: %s", e)
+        await update.message.reply_text("상품 등록 중 오류 발생.\n" + COMMAND_GUIDE)
     finally:
-        session.close()
+        await session.close()
     return ConversationHandler.END
 
 sell_handler = ConversationHandler(
     entry_points=[CommandHandler("sell", sell_command)],
     states={
-        WAITING_FOR_ITEM_NAME: [MessageHandler(filters.TEXT & ~filters.COMMAND, set_item_name)],
-        WAITING_FOR_PRICE: [MessageHandler(filters.TEXT & ~filters.COMMAND, set_item_price)],
-        WAITING_FOR_ITEM_TYPE: [MessageHandler(filters.TEXT & ~filters.COMMAND, set_item_type)],
+        WAITING_FOR_ITEM_NAME: [MessageHandler(TEXT_INPUT, set_item_name)],
+        WAITING_FOR_PRICE: [MessageHandler(TEXT_INPUT, set_item_price)],
+        WAITING_FOR_ITEM_TYPE: [MessageHandler(TEXT_INPUT, set_item_type)],
     },
-    fallbacks=[CommandHandler("exit", exit_to_start), MessageHandler(filters.COMMAND, exit_to_start)],
+    fallbacks=CONVERSATION_FALLBACKS,
 )
 
 # ==============================
-# /list, /next, /prev
-@check_banned
-async def list_items_command(update: Update, context: CallbackContext) -> None:
+# 상품 목록 페이지 (/list, /search, /cancel 공용)
+LIST_FOOTER = "\n/next, /prev 로 페이지 이동\n/offer [번호/이름] 으로 거래 요청"
+CANCEL_FOOTER = "\n/next, /prev 로 페이지 이동\n취소할 상품 번호/이름 입력.\n(취소: /exit)"
+
+# 등록/취소 등 상품 목록이 바뀔 때마다 올려서 렌더링 캐시를 무효화
+ITEM_PAGE_CACHE_SIZE = 64
+item_list_version = 0
+item_page_cache = OrderedDict()  # (버전, 쿼리, 파라미터, 페이지, 제목, 꼬리말) → build_item_page 결과
+# 페이지 넘길 때마다 COUNT 하지 않도록 목록 전체 개수도 잠시 보관
+ITEM_COUNT_TTL = 30  # 초
+item_count_cache = {}  # (버전, 쿼리, 파라미터) → (개수, 만료 시각)
+# 목록 쿼리는 모두 Item.id 순 → 페이지별 첫/마지막 ID 를 기억해 이웃 페이지는 keyset 으로 조회
+ITEM_PAGE_BOUNDS_SIZE = 256
+item_page_bounds = {}  # (버전, 쿼리, 파라미터, 페이지) → (첫 상품 ID, 마지막 상품 ID)
+# Redis 사용 시(여러 인스턴스) 목록 버전을 Redis 에 두고, 다른 인스턴스의 등록/취소도 캐시에 반영
+ITEM_LIST_VERSION_KEY = "item_list_version"
+item_list_shared_version = None  # 마지막으로 확인한 Redis 목록 버전
+
+def clear_item_pages():
+    global item_list_version
+    item_list_version += 1
+    item_page_cache.clear()
+    item_count_cache.clear()
+    item_page_bounds.clear()
+
+async def invalidate_item_pages():
+    clear_item_pages()
+    if redis_client is not None:
+        try:
+            await redis_client.incr(ITEM_LIST_VERSION_KEY)
+        except Exception as e:
+            logging.error("목록 버전 갱신 오류: %s", e)
+
+async def sync_item_list_version():
+    # Redis 의 목록 버전이 바뀌었으면(다른 인스턴스에서 변경) 로컬 캐시 비움
+    global item_list_shared_version
+    if redis_client is None:
+        return
+    try:
+        shared = await redis_client.get(ITEM_LIST_VERSION_KEY)
+    except Exception as e:
+        logging.error("목록 버전 조회 오류: %s", e)
+        clear_item_pages()  # 확인할 수 없으면 캐시를 쓰지 않음
+        return
+    if shared != item_list_shared_version:
+        item_list_shared_version = shared
+        clear_item_pages()
+
+async def count_items(session, stmt, params: tuple) -> int:
+    key = (item_list_version, stmt, params)
+    now = time.monotonic()
+    cached = item_count_cache.get(key)
+    if cached and cached[1] > now:
+        return cached[0]
+    total = await session.scalar(select(func.count()).select_from(stmt.order_by(None).subquery()), dict(params))
+    if len(item_count_cache) >= ITEM_PAGE_CACHE_SIZE:  # 검색어별 항목이 쌓이지 않도록 만료분 정리
+        for k in [k for k, (_, expires) in item_count_cache.items() if expires <= now]:
+            del item_count_cache[k]
+    item_count_cache[key] = (total, now + ITEM_COUNT_TTL)
+    return total
+
+async def build_item_page(stmt, params: tuple, page: int, title: str, footer: str, state_key: str):
+    # (실제 페이지, 메시지, 번호→상품ID 튜플) 반환, 상품이 없으면 None
+    # 같은 목록 버전/검색어/페이지면 SQL·문자열 조립 없이 캐시된 결과 재사용
+    key = (item_list_version, stmt, params, page, title, footer)
+    if key in item_page_cache:
+        item_page_cache.move_to_end(key)
+        return item_page_cache[key]
+    # 로컬에 없으면 다른 인스턴스가 만든 페이지(Redis) → 그래도 없으면 DB
+    shared_key = f"items:page:{item_list_shared_version}:{state_key}:{params!r}:{page}"
+    rendered = await load_shared_item_page(shared_key)
+    if rendered is None:
+        rendered = await query_item_page(stmt, params, page, title, footer)
+        await store_shared_item_page(shared_key, rendered)
+    item_page_cache[key] = rendered
+    if len(item_page_cache) > ITEM_PAGE_CACHE_SIZE:
+        item_page_cache.popitem(last=False)
+    return rendered
+
+# Redis 사용 시 렌더링한 페이지를 인스턴스 간 공유 (키에 목록 버전이 들어가므로 등록/취소 시 자연히 무효화)
+ITEM_PAGE_SHARED_TTL = 30  # 초
+
+async def load_shared_item_page(shared_key: str):
+    if redis_client is None:
+        return None
+    try:
+        cached = await redis_client.get(shared_key)
+    except Exception as e:
+        logging.error("목록 캐시 조회 오류: %s", e)
+        return None
+    if cached is None:
+        return None
+    page, msg, mapping = json.loads(cached)
+    return page, msg, tuple((number, item_id) for number, item_id in mapping)
+
+async def store_shared_item_page(shared_key: str, rendered) -> None:
+    if redis_client is None or rendered is None:
+        return
+    try:
+        await redis_client.set(shared_key, json.dumps(rendered, ensure_ascii=False), ex=ITEM_PAGE_SHARED_TTL)
+    except Exception as e:
+        logging.error("목록 캐시 저장 오류: %s", e)
+
+async def query_item_page(stmt, params: tuple, page: int, title: str, footer: str):
+    version = item_list_version
     session = get_db_session()
     try:
-        page = context.user_data.get("list_page", 1)
-        items = session.query(Item).filter(Item.status == "available").all()
-        if not items:
-            await update.message.reply_text("등록된 상품 없음.\n" + command_guide())
-            return
+        total = await count_items(session, stmt, params)
+        if not total:
+            return None
 
-        total_pages = (len(items) - 1) // ITEMS_PER_PAGE + 1
+        total_pages = (total - 1) // ITEMS_PER_PAGE + 1
         if page < 1:
             page = total_pages
         elif page > total_pages:
             page = 1
-        context.user_data["list_page"] = page
 
-        start = (page - 1) * ITEMS_PER_PAGE
-        end = start + ITEMS_PER_PAGE
-        page_items = items[start:end]
-
-        context.user_data["list_mapping"] = {
-            str(idx): it.id for idx, it in enumerate(page_items, start=1)
-        }
-
-        msg = f"구매 가능한 상품 목록 (페이지 {page}/{total_pages}):\n"
-        for idx, it in enumerate(page_items, start=1):
-            msg += f"{idx}. {it.name} - {it.price} USDT ({it.type})\n"
+        # 현재 페이지 분량만 DB에서 가져옴 (OFFSET 은 앞 페이지를 모두 읽고 버리므로 가능하면 keyset)
+        # - 앞 페이지를 봤으면: id > 앞 페이지 마지막 ID
+        # - 뒤 페이지를 봤거나(/prev) 마지막 페이지면: id 역순으로 읽고 뒤집음
+        prev_bounds = item_page_bounds.get((version, stmt, params, page - 1))
+        next_bounds = item_page_bounds.get((version, stmt, params, page + 1))
+        reverse_stmt = None
+        if prev_bounds:
+            page_stmt = stmt.where(Item.id > prev_bounds[1]).limit(ITEMS_PER_PAGE)
+        elif next_bounds:
+            reverse_stmt = stmt.where(Item.id < next_bounds[0]).limit(ITEMS_PER_PAGE)
+        elif page == total_pages:
+            reverse_stmt = stmt.limit(total - (total_pages - 1) * ITEMS_PER_PAGE)
+        else:
+            page_stmt = stmt.offset((page - 1) * ITEMS_PER_PAGE).limit(ITEMS_PER_PAGE)
+        if reverse_stmt is not None:
+            reverse_stmt = reverse_stmt.order_by(None).order_by(Item.id.desc())
+            page_items = (await session.execute(reverse_stmt, dict(params))).all()[::-1]
+        else:
+            page_items = (await session.execute(page_stmt, dict(params))).all()
+    finally:
+        await session.close()
+
+    if page_items:
+        if len(item_page_bounds) >= ITEM_PAGE_BOUNDS_SIZE:
+            item_page_bounds.clear()
+        item_page_bounds[(version, stmt, params, page)] = (page_items[0].id, page_items[-1].id)
+
+    # 메시지 줄과 번호→상품ID 를 한 번의 순회로 만들고 마지막에 join 한 번
+    lines = [f"{title} (페이지 {page}/{total_pages}):"]
+    mapping = []
+    for idx, it in enumerate(page_items, start=1):
+        lines.append(f"{idx}. {it.name} - {it.price} USDT ({it.type})")
+        mapping.append((str(idx), it.id))
+    lines.append(footer + COMMAND_GUIDE)
+    return page, "\n".join(lines), tuple(mapping)
+
+async def render_item_page(context: CallbackContext, stmt, params: dict, state_key: str, title: str, footer: str):
+    # context.user_data 의 "{state_key}_page" 페이지를 렌더링하고 "{state_key}_mapping" 에 번호→상품ID 저장
+    # 상품이 없으면 None
+    await sync_item_list_version()
+    rendered = await build_item_page(
+        stmt, tuple(sorted(params.items())),
+        context.user_data.get(f"{state_key}_page", 1), title, footer, state_key
+    )
+    if rendered is None:
+        return None
+    page, msg, mapping = rendered
+    context.user_data[f"{state_key}_page"] = page
+    context.user_data[f"{state_key}_mapping"] = dict(mapping)
+    return msg
 
-        msg += "\n/next, /prev 로 페이지 이동\n/offer [번호/이름] 으로 거래 요청"
-        await update.message.reply_text(msg + command_guide())
+# ==============================
+# /list, /next, /prev
+@check_banned
+async def list_items_command(update: Update, context: CallbackContext) -> None:
+    try:
+        msg = await render_item_page(context, AVAILABLE_ITEMS, {}, "list", "구매 가능한 상품 목록", LIST_FOOTER)
+        if not msg:
+            await update.message.reply_text("등록된 상품 없음.\n" + COMMAND_GUIDE)
+            return
+        await update.message.reply_text(msg)
     except Exception as e:
-        logging.error(f"/list 오류: {e}")
-        await update.message.reply_text("상품 목록 조회 중 오류.\n" + command_guide())
-    finally:
-        session.close()
+        logging.error("/list 오류: %s", e)
+        await update.message.reply_text("상품 목록 조회 중 오류.\n" + COMMAND_GUIDE)
 
 @check_banned
 async def next_page(update: Update, context: CallbackContext) -> None:
@@ -405,7 +1019,7 @@ async def prev_page(update: Update, context: CallbackContext) -> None:
 async def search_items_command(update: Update, context: CallbackContext) -> None:
     args = update.message.text.split(maxsplit=1)
     if len(args) < 2:
-        await update.message.reply_text("사용법: /search [검색어]\n" + command_guide())
+        await update.message.reply_text("사용법: /search [검색어]\n" + COMMAND_GUIDE)
         return
     query = args[1].strip().lower()
     context.user_data["search_query"] = query
@@ -414,41 +1028,19 @@ async def search_items_command(update: Update, context: CallbackContext) -> None
 
 @check_banned
 async def list_search_results(update: Update, context: CallbackContext) -> None:
-    session = get_db_session()
     try:
         query = context.user_data.get("search_query", "")
-        page = context.user_data.get("search_page", 1)
-        items = session.query(Item).filter(Item.name.ilike(f"%{query}%"), Item.status == "available").all()
-        if not items:
-            await update.message.reply_text(f"'{query}' 검색 결과 없음.\n" + command_guide())
+        msg = await render_item_page(
+            context, SEARCH_AVAILABLE_ITEMS, {"pattern": f"%{query}%"},
+            "search", f"'{query}' 검색 결과", LIST_FOOTER
+        )
+        if not msg:
+            await update.message.reply_text(f"'{query}' 검색 결과 없음.\n" + COMMAND_GUIDE)
             return
-
-        total_pages = (len(items) - 1) // ITEMS_PER_PAGE + 1
-        if page < 1:
-            page = total_pages
-        elif page > total_pages:
-            page = 1
-        context.user_data["search_page"] = page
-
-        start = (page - 1) * ITEMS_PER_PAGE
-        end = start + ITEMS_PER_PAGE
-        page_items = items[start:end]
-
-        context.user_data["search_mapping"] = {
-            str(idx): it.id for idx, it in enumerate(page_items, start=1)
-        }
-
-        msg = f"'{query}' 검색 결과 (페이지 {page}/{total_pages}):\n"
-        for idx, it in enumerate(page_items, start=1):
-            msg += f"{idx}. {it.name} - {it.price} USDT ({it.type})\n"
-
-        msg += "\n/next, /prev 로 페이지 이동\n/offer [번호/이름] 으로 거래 요청"
-        await update.message.reply_text(msg + command_guide())
+        await update.message.reply_text(msg)
     except Exception as e:
-        logging.error(f"/search 오류: {e}")
-        await update.message.reply_text("상품 검색 중 오류.\n" + command_guide())
-    finally:
-        session.close()
+        logging.error("/search 오류: %s", e)
+        await update.message.reply_text("상품 검색 중 오류.\n" + COMMAND_GUIDE)
 
 # ==============================
 # /offer
@@ -456,102 +1048,72 @@ async def list_search_results(update: Update, context: CallbackContext) -> None:
 async def offer_item(update: Update, context: CallbackContext) -> None:
     args = update.message.text.split(maxsplit=1)
     if len(args) < 2:
-        await update.message.reply_text("사용법: /offer [번호/상품이름]\n" + command_guide())
+        await update.message.reply_text("사용법: /offer [번호/상품이름]\n" + COMMAND_GUIDE)
         return
     identifier = args[1].strip()
     session = get_db_session()
     try:
         mapping = context.user_data.get("list_mapping") or context.user_data.get("search_mapping") or {}
+        # 목록 번호면 상품 ID 를 이미 알고 있으므로 조회 없이 바로 INSERT
         if identifier in mapping:
             item_id = mapping[identifier]
-            item = session.query(Item).filter_by(id=item_id, status="available").first()
         else:
+            if ITEM_ID_PATTERN.fullmatch(identifier):
+                item_id = await session.scalar(
+                    FIND_AVAILABLE_ITEM_ID_BY_ID_OR_NAME, {"item_id": int(identifier), "pattern": f"%{identifier}%"}
+                )
+            else:
+                item_id = await session.scalar(FIND_AVAILABLE_ITEM_ID_BY_NAME, {"pattern": f"%{identifier}%"})
+            if item_id is None:
+                await update.message.reply_text("유효한 상품 번호/이름을 입력.\n" + COMMAND_GUIDE)
+                return
+
+        # transaction_id 는 unique: 충돌 시 IntegrityError → 새 ID 로 재시도
+        for _ in range(TRANSACTION_ID_RETRIES):
+            t_id = generate_transaction_id()
             try:
-                item_id_int = int(identifier)
-                item = session.query(Item).filter_by(id=item_id_int, status="available").first()
-            except ValueError:
-                item = session.query(Item).filter(
-                    Item.name.ilike(f"%{identifier}%"),
-                    Item.status == "available"
-                ).first()
-        if not item:
-            await update.message.reply_text("유효한 상품 번호/이름을 입력.\n" + command_guide())
+                row = (await session.execute(
+                    OFFER_ITEM, {"item_id": item_id, "buyer": update.message.from_user.id, "t_id": t_id}
+                )).first()
+                await session.commit()
+                break
+            except IntegrityError:
+                await session.rollback()
+        else:
+            raise RuntimeError("거래 ID 생성 실패")
+        if not row:  # 그 사이 취소되었거나 판매 중이 아닌 상품
+            await update.message.reply_text("유효한 상품 번호/이름을 입력.\n" + COMMAND_GUIDE)
             return
+        seller_id, item_name = row
 
-        buyer_id = update.message.from_user.id
-        seller_id = item.seller_id
-        t_id = ''.join(str(random.randint(0, 9)) for _ in range(12))
-
-        new_tx = Transaction(
-            item_id=item.id,
-            buyer_id=buyer_id,
-            seller_id=seller_id,
-            amount=item.price,
-            transaction_id=t_id,
-        )
-        session.add(new_tx)
-        session.commit()
-
-        await update.message.reply_text(
-            f"'{item.name}' 거래 요청 생성!\n거래 ID: {t_id}\n(송금 시 메모 필수)\n" + command_guide()
-        )
-        try:
-            await context.bot.send_message(
-                chat_id=seller_id,
-                text=(
-                    f"상품 '{item.name}'에 거래 요청이 도착했습니다.\n거래 ID: {t_id}\n"
-                    "판매자: /accept 거래ID 판매자지갑 /refusal 거래ID"
-                )
-            )
-        except Exception as e:
-            logging.error(f"판매자 알림 오류: {e}")
+        await update.message.reply_text(OFFER_CREATED_TEMPLATE.format(name=item_name, t_id=t_id))
+        notify(seller_id, OFFER_NOTICE_TEMPLATE.format(name=item_name, t_id=t_id))
     except Exception as e:
-        session.rollback()
-        logging.error(f"/offer 오류: {e}")
-        await update.message.reply_text("거래 요청 중 오류.\n" + command_guide())
+        await session.rollback()
+        logging.error("/offer 오류: %s", e)
+        await update.message.reply_text("거래 요청 중 오류.\n" + COMMAND_GUIDE)
     finally:
-        session.close()
+        await session.close()
 
 # ==============================
 # /cancel (ConversationHandler)
 @check_banned
 async def cancel(update: Update, context: CallbackContext) -> int:
-    session = get_db_session()
     try:
         seller_id = update.message.from_user.id
-        items = session.query(Item).filter(Item.seller_id == seller_id, Item.status == "available").all()
-        if not items:
-            await update.message.reply_text("취소할 상품이 없습니다.\n" + command_guide())
+        msg = await render_item_page(
+            context, SELLER_AVAILABLE_ITEMS, {"seller_id": seller_id},
+            "cancel", "취소 가능한 상품 목록", CANCEL_FOOTER
+        )
+        if not msg:
+            await update.message.reply_text("취소할 상품이 없습니다.\n" + COMMAND_GUIDE)
             return ConversationHandler.END
-
-        page = context.user_data.get("cancel_page", 1)
-        total_pages = (len(items) - 1) // ITEMS_PER_PAGE + 1
-        if page < 1:
-            page = total_pages
-        elif page > total_pages:
-            page = 1
-        context.user_data["cancel_page"] = page
-
-        start = (page - 1) * ITEMS_PER_PAGE
-        end = start + ITEMS_PER_PAGE
-        page_items = items[start:end]
-
-        context.user_data["cancel_mapping"] = {
-            str(idx): it.id for idx, it in enumerate(page_items, start=1)
-        }
-        msg = f"취소 가능한 상품 목록 (페이지 {page}/{total_pages}):\n"
-        for idx, it in enumerate(page_items, start=1):
-            msg += f"{idx}. {it.name} - {it.price} USDT ({it.type})\n"
-
-        msg += "\n/next, /prev 로 페이지 이동\n취소할 상품 번호/이름 입력.\n(취소: /exit)"
-        await update.message.reply_text(msg + command_guide())
+        await update.message.reply_text(msg)
         return WAITING_FOR_CANCEL_ID
     except Exception as e:
-        logging.error(f"/cancel 오류: {e}")
-        await update.message.reply_text("상품 취소 목록 조회 중 오류.\n" + command_guide())
+        logging.error("/cancel 오류: %s", e)
+        await update.message.reply_text("상품 취소 목록 조회 중 오류.\n" + COMMAND_GUIDE)
         return ConversationHandler.END
-    finally:
-        session.close()
 
 @check_banned
 async def cancel_item(update: Update, context: CallbackContext) -> int:
@@ -563,236 +1125,252 @@ async def cancel_item(update: Update, context: CallbackContext) -> int:
         seller_id = update.message.from_user.id
         mapping = context.user_data.get("cancel_mapping") or {}
         if identifier in mapping:
-            item_id = mapping[identifier]
-            item = session.query(Item).filter_by(id=item_id, seller_id=seller_id, status="available").first()
+            item_name = await session.scalar(
+                CANCEL_SELLER_ITEM_BY_ID, {"item_id": mapping[identifier], "seller_id": seller_id}
+            )
+        elif ITEM_ID_PATTERN.fullmatch(identifier):
+            item_name = await session.scalar(
+                CANCEL_SELLER_ITEM_BY_ID_OR_NAME,
+                {"item_id": int(identifier), "pattern": f"%{identifier}%", "seller_id": seller_id},
+            )
         else:
-            try:
-                item_id_int = int(identifier)
-                item = session.query(Item).filter_by(id=item_id_int, seller_id=seller_id, status="available").first()
-            except ValueError:
-                item = session.query(Item).filter(
-                    Item.name.ilike(f"%{identifier}%"),
-                    Item.seller_id == seller_id,
-                    Item.status == "available"
-                ).first()
-        if not item:
-            await update.message.reply_text("유효한 상품 번호/이름 없음.\n" + command_guide())
+            item_name = await session.scalar(
+                CANCEL_SELLER_ITEM_BY_NAME, {"pattern": f"%{identifier}%", "seller_id": seller_id}
+            )
+        if item_name is None:
+            await session.rollback()
+            await update.message.reply_text("유효한 상품 번호/이름 없음.\n" + COMMAND_GUIDE)
             return WAITING_FOR_CANCEL_ID
 
-        session.delete(item)
-        session.commit()
-        await update.message.reply_text(f"'{item.name}' 상품 취소됨.\n" + command_guide())
+        await session.commit()
+        await invalidate_item_pages()
+        await update.message.reply_text(f"'{item_name}' 상품 취소됨.\n" + COMMAND_GUIDE)
         return ConversationHandler.END
     except Exception as e:
-        session.rollback()
-        logging.error(f"/cancel 처리 오류: {e}")
-        await update.message.reply_text("상품 취소 처리 중 오류.\n" + command_guide())
+        await session.rollback()
+        logging.error("/cancel 처리 오류: %s", e)
+        await update.message.reply_text("상품 취소 처리 중 오류.\n" + COMMAND_GUIDE)
         return WAITING_FOR_CANCEL_ID
     finally:
-        session.close()
+        await session.close()
 
 cancel_handler = ConversationHandler(
     entry_points=[CommandHandler("cancel", cancel)],
     states={
-        WAITING_FOR_CANCEL_ID: [MessageHandler(filters.TEXT & ~filters.COMMAND, cancel_item)],
+        WAITING_FOR_CANCEL_ID: [MessageHandler(TEXT_INPUT, cancel_item)],
     },
-    fallbacks=[CommandHandler("exit", exit_to_start), MessageHandler(filters.COMMAND, exit_to_start)],
+    fallbacks=CONVERSATION_FALLBACKS,
 )
 
 # ==============================
 # /accept (판매자)
 @check_banned
 async def accept_transaction(update: Update, context: CallbackContext) -> None:
-    args = update.message.text.split()
-    if len(args) < 3:
-        await update.message.reply_text("사용법: /accept 거래ID 판매자지갑\n" + command_guide())
+    if len(context.args) < 2:
+        await update.message.reply_text("사용법: /accept 거래ID 판매자지갑\n" + COMMAND_GUIDE)
         return
-    t_id = args[1].strip()
-    seller_wallet = args[2].strip()
+    t_id = context.args[0]
+    seller_wallet = context.args[1]
     session = get_db_session()
     try:
-        tx = session.query(Transaction).filter_by(transaction_id=t_id, status="pending").first()
-        if not tx:
-            await update.message.reply_text("유효한 거래 ID가 아니거나 이미 처리됨.\n" + command_guide())
-            return
-        if update.message.from_user.id != tx.seller_id:
-            await update.message.reply_text("판매자만 가능.\n" + command_guide())
+        # 상태 확인과 변경을 한 번의 UPDATE로 처리 (동시 수락 방지), 상품 이름도 같은 왕복에서 받음
+        row = (await session.execute(
+            ACCEPT_TRANSACTION,
+            {"t_id": t_id, "seller": update.message.from_user.id, "seller_wallet": seller_wallet},
+        )).first()
+        if not row:
+            await session.rollback()
+            if await session.scalar(TRANSACTION_ID_BY_STATUS, {"t_id": t_id, "status": "pending"}):
+                await update.message.reply_text("판매자만 가능.\n" + COMMAND_GUIDE)
+            else:
+                await update.message.reply_text("유효한 거래 ID가 아니거나 이미 처리됨.\n" + COMMAND_GUIDE)
             return
-        tx.session_id = seller_wallet
-        tx.status = "accepted"
-        session.commit()
-        await update.message.reply_text(f"거래 ID {t_id} 수락됨. 구매자에게 송금 안내.\n" + command_guide())
-        try:
-            await context.bot.send_message(
-                chat_id=tx.buyer_id,
-                text=(
-                    f"거래 ID {t_id} 수락됨.\n"
-                    f"해당 금액({tx.amount} USDT)를 {TRON_WALLET} 로 송금할 때, 메모(거래ID:{t_id}) 기입 필수."
-                )
-            )
-        except Exception as e:
-            logging.error(f"구매자 알림 오류: {e}")
+        await session.commit()
+        buyer_id, amount, item_id, item_name = row
+        item_name = item_name or item_id
+        await update.message.reply_text(ACCEPTED_TEMPLATE.format(t_id=t_id))
+        notify(buyer_id, ACCEPT_NOTICE_TEMPLATE.format(t_id=t_id, name=item_name, amount=amount, wallet=TRON_WALLET))
     except Exception as e:
-        session.rollback()
-        logging.error(f"/accept 오류: {e}")
-        await update.message.reply_text("거래 수락 중 오류.\n" + command_guide())
+        await session.rollback()
+        logging.error("/accept 오류: %s", e)
+        await update.message.reply_text("거래 수락 중 오류.\n" + COMMAND_GUIDE)
     finally:
-        session.close()
+        await session.close()
 
 # ==============================
 # /refusal (판매자)
 @check_banned
 async def refusal_transaction(update: Update, context: CallbackContext) -> None:
-    args = update.message.text.split(maxsplit=1)
-    if len(args) < 2:
-        await update.message.reply_text("사용법: /refusal 거래ID\n" + command_guide())
+    if not context.args:
+        await update.message.reply_text("사용법: /refusal 거래ID\n" + COMMAND_GUIDE)
         return
-    t_id = args[1].strip()
+    t_id = context.args[0]
     session = get_db_session()
     try:
-        tx = session.query(Transaction).filter_by(transaction_id=t_id, status="pending").first()
-        if not tx:
-            await update.message.reply_text("유효한 거래 ID가 아니거나 이미 처리됨.\n" + command_guide())
-            return
-        if update.message.from_user.id != tx.seller_id:
-            await update.message.reply_text("판매자만 사용 가능.\n" + command_guide())
-            return
-        session.delete(tx)
-        session.commit()
-        await update.message.reply_text(f"거래 ID {t_id} 거절됨.\n" + command_guide())
-        try:
-            await context.bot.send_message(
-                chat_id=tx.buyer_id,
-                text=f"거래 제안(거래ID {t_id})이 거절되었습니다."
+        buyer_id = await session.scalar(
+            delete(Transaction)
+            .where(
+                Transaction.transaction_id == t_id,
+                Transaction.status == "pending",
+                Transaction.seller_id == update.message.from_user.id,
             )
-        except Exception as e:
-            logging.error(f"거절 알림 오류: {e}")
+            .returning(Transaction.buyer_id)
+            .execution_options(synchronize_session=False)
+        )
+        if buyer_id is None:
+            await session.rollback()
+            if await session.scalar(TRANSACTION_ID_BY_STATUS, {"t_id": t_id, "status": "pending"}):
+                await update.message.reply_text("판매자만 사용 가능.\n" + COMMAND_GUIDE)
+            else:
+                await update.message.reply_text("유효한 거래 ID가 아니거나 이미 처리됨.\n" + COMMAND_GUIDE)
+            return
+        await session.commit()
+        await update.message.reply_text(f"거래 ID {t_id} 거절됨.\n" + COMMAND_GUIDE)
+        notify(buyer_id, f"거래 제안(거래ID {t_id})이 거절되었습니다.")
     except Exception as e:
-        session.rollback()
-        logging.error(f"/refusal 오류: {e}")
-        await update.message.reply_text("거래 거절 중 오류.\n" + command_guide())
+        await session.rollback()
+        logging.error("/refusal 오류: %s", e)
+        await update.message.reply_text("거래 거절 중 오류.\n" + COMMAND_GUIDE)
     finally:
-        session.close()
+        await session.close()
+
+# ==============================
+# 거래 상태 변경: 현재 상태 조건을 건 UPDATE 한 번 (성공 시 True)
+# SELECT 후 변경하는 사이에 다른 명령이 상태를 바꾸는 경쟁을 막음
+async def transition_status(session, t_id, from_status, to_status, buyer_id=None):
+    stmt = sql_update(Transaction).where(
+        Transaction.transaction_id == t_id,
+        Transaction.status == from_status,
+    )
+    if buyer_id is not None:
+        stmt = stmt.where(Transaction.buyer_id == buyer_id)
+    row = (await session.execute(
+        stmt.values(status=to_status)
+        .returning(Transaction.id)
+        .execution_options(synchronize_session=False)
+    )).first()
+    return row is not None
 
 # ==============================
 # /checkdeposit (구매자)
 @check_banned
 async def check_deposit(update: Update, context: CallbackContext) -> None:
-    args = update.message.text.split()
-    if len(args) < 3:
-        await update.message.reply_text("사용법: /checkdeposit 거래ID txid\n" + command_guide())
+    if len(context.args) < 2:
+        await update.message.reply_text("사용법: /checkdeposit 거래ID txid\n" + COMMAND_GUIDE)
         return
-    t_id = args[1].strip()
-    txid = args[2].strip()
+    t_id = context.args[0]
+    txid = context.args[1]
     session = get_db_session()
     try:
-        tx = session.query(Transaction).filter_by(transaction_id=t_id, status="accepted").first()
+        tx = await session.scalar(FIND_TRANSACTION_WITH_ITEM, {"t_id": t_id, "status": "accepted"})
         if not tx:
-            await update.message.reply_text("유효한 거래가 아니거나 아직 수락되지 않음.\n" + command_guide())
+            await update.message.reply_text("유효한 거래가 아니거나 아직 수락되지 않음.\n" + COMMAND_GUIDE)
             return
-        valid, deposited_amount = verify_deposit(float(tx.amount), txid, t_id)
+        # 온체인 조회(수 초) 동안 풀 연결을 잡고 있지 않도록 읽기 트랜잭션을 먼저 끝냄
+        await session.commit()
+        valid, deposited_amount = await verify_deposit(tx.amount, txid, t_id)
         if not valid:
-            await update.message.reply_text("입금 내역 확인 실패.\n" + command_guide())
+            await update.message.reply_text("입금 내역 확인 실패.\n" + COMMAND_GUIDE)
             return
-        tx.status = "deposit_confirmed"
-        session.commit()
-        await update.message.reply_text("입금 확인됨. 안내 메시지 전송.\n" + command_guide())
-        await context.bot.send_message(
-            chat_id=tx.seller_id,
-            text=(f"거래 ID {t_id} 입금 확인됨.\n판매자: 물품 발송 후 /confirm 명령어로 거래 완료 처리하세요.")
-        )
+        seller_id = tx.seller_id
+        item_name = tx.item.name if tx.item else tx.item_id
+        # 입금 검증 동안 상태가 바뀌었을 수 있으므로 상태 조건을 건 UPDATE 로 변경
+        if not await transition_status(session, t_id, "accepted", "deposit_confirmed"):
+            await update.message.reply_text("이미 처리된 거래입니다.\n" + COMMAND_GUIDE)
+            return
+        await session.commit()
+        await update.message.reply_text("입금 확인됨. 안내 메시지 전송.\n" + COMMAND_GUIDE)
+        notify(seller_id, DEPOSIT_NOTICE_TEMPLATE.format(t_id=t_id, name=item_name))
     except Exception as e:
-        session.rollback()
-        logging.error(f"/checkdeposit 오류: {e}")
-        await update.message.reply_text("입금 확인 중 오류.\n" + command_guide())
+        await session.rollback()
+        logging.error("/checkdeposit 오류: %s", e)
+        await update.message.reply_text("입금 확인 중 오류.\n" + COMMAND_GUIDE)
     finally:
-        session.close()
+        await session.close()
 
 # ==============================
 # /confirm (구매자)
 @check_banned
 async def confirm_payment(update: Update, context: CallbackContext) -> None:
-    args = update.message.text.split()
-    if len(args) < 4:
-        await update.message.reply_text("사용법: /confirm 거래ID 구매자지갑 txid\n" + command_guide())
+    if len(context.args) < 3:
+        await update.message.reply_text("사용법: /confirm 거래ID 구매자지갑 txid\n" + COMMAND_GUIDE)
         return
-    t_id = args[1].strip()
-    buyer_wallet = args[2].strip()
-    txid = args[3].strip()
+    t_id = context.args[0]
+    buyer_wallet = context.args[1]
+    txid = context.args[2]
     session = get_db_session()
     try:
-        tx = session.query(Transaction).filter_by(transaction_id=t_id, status="deposit_confirmed").first()
+        tx = await session.scalar(FIND_TRANSACTION_WITH_ITEM, {"t_id": t_id, "status": "deposit_confirmed"})
         if not tx:
-            await update.message.reply_text("아직 입금확인 안 됐거나 상태 불일치.\n" + command_guide())
+            await update.message.reply_text("아직 입금확인 안 됐거나 상태 불일치.\n" + COMMAND_GUIDE)
             return
         if update.message.from_user.id != tx.buyer_id:
-            await update.message.reply_text("구매자만 사용 가능.\n" + command_guide())
+            await update.message.reply_text("구매자만 사용 가능.\n" + COMMAND_GUIDE)
             return
-        original_amount = float(tx.amount)
-        valid, _ = verify_deposit(original_amount, txid, t_id)
+        original_amount = tx.amount
+        # 온체인 조회 동안 풀 연결 반환 (/checkdeposit 과 동일)
+        await session.commit()
+        valid, _ = await verify_deposit(original_amount, txid, t_id)
         if not valid:
-            await update.message.reply_text("TXID/메모가 일치하지 않음.\n" + command_guide())
+            await update.message.reply_text("TXID/메모가 일치하지 않음.\n" + COMMAND_GUIDE)
             return
 
-        net_amount = original_amount * (1 - NORMAL_COMMISSION_RATE)
-        tx.status = "completed"
-        session.commit()
-        await update.message.reply_text(
-            f"입금 최종 확인({original_amount} USDT). 판매자에게 {net_amount} USDT 송금!\n" + command_guide()
-        )
+        net_amount = usdt_amount(original_amount * NORMAL_PAYOUT_RATE)
+        seller_id, seller_wallet = tx.seller_id, tx.session_id
+        item_name = tx.item.name if tx.item else tx.item_id
+        # 동시에 들어온 /confirm 이 판매자에게 두 번 송금하지 않도록 상태 조건을 건 UPDATE 로 변경
+        # (같은 문장에서 상품도 판매완료로 바꿔 목록에서 내림)
+        completed = (await session.execute(COMPLETE_TRANSACTION, {"t_id": t_id, "buyer": tx.buyer_id})).first()
+        if not completed:
+            await update.message.reply_text("이미 처리된 거래입니다.\n" + COMMAND_GUIDE)
+            return
+        await session.commit()
+        await invalidate_item_pages()
+        await update.message.reply_text(CONFIRMED_TEMPLATE.format(amount=format_usdt(original_amount), net_amount=format_usdt(net_amount)))
         try:
-            seller_wallet = tx.session_id
-            result = send_usdt(seller_wallet, net_amount, memo=t_id)
-            await context.bot.send_message(
-                chat_id=tx.seller_id,
-                text=(
-                    f"거래 ID {t_id} 완료.\n"
-                    f"{net_amount} USDT가 판매자 지갑({seller_wallet})으로 송금됨.\n"
-                    f"송금 결과: {result}"
-                )
-            )
+            result = await send_usdt(seller_wallet, net_amount, memo=t_id)
+            notify(seller_id, COMPLETED_NOTICE_TEMPLATE.format(
+                t_id=t_id, name=item_name, net_amount=format_usdt(net_amount), wallet=seller_wallet, result=result
+            ))
         except Exception as e:
-            logging.error(f"판매자 송금 오류: {e}")
+            logging.error("판매자 송금 오류: %s", e, exc_info=True)
     except Exception as e:
-        session.rollback()
-        logging.error(f"/confirm 오류: {e}")
-        await update.message.reply_text("거래 완료 중 오류.\n" + command_guide())
+        await session.rollback()
+        logging.error("/confirm 오류: %s", e)
+        await update.message.reply_text("거래 완료 중 오류.\n" + COMMAND_GUIDE)
     finally:
-        session.close()
+        await session.close()
 
 # ==============================
 # /refund (구매자, ConversationHandler)
 @check_banned
 async def refund_request(update: Update, context: CallbackContext) -> int:
-    args = update.message.text.split(maxsplit=1)
-    if len(args) < 2:
-        await update.message.reply_text("사용법: /refund 거래ID\n" + command_guide())
+    if not context.args:
+        await update.message.reply_text("사용법: /refund 거래ID\n" + COMMAND_GUIDE)
         return ConversationHandler.END
-    t_id = args[1].strip()
+    t_id = context.args[0]
     session = get_db_session()
     try:
-        tx = session.query(Transaction).filter_by(transaction_id=t_id, status="deposit_confirmed").first()
+        tx = await session.scalar(FIND_TRANSACTION_BY_STATUS, {"t_id": t_id, "status": "deposit_confirmed"})
         if not tx:
-            await update.message.reply_text("유효한 거래 ID 아니거나 환불 불가.\n" + command_guide())
+            await update.message.reply_text("유효한 거래 ID 아니거나 환불 불가.\n" + COMMAND_GUIDE)
             return ConversationHandler.END
         if update.message.from_user.id != tx.buyer_id:
-            await update.message.reply_text("구매자만 환불 요청.\n" + command_guide())
+            await update.message.reply_text("구매자만 환불 요청.\n" + COMMAND_GUIDE)
             return ConversationHandler.END
 
-        original_amount = float(tx.amount)
-        refund_amount = original_amount * 0.975  # 예: 수수료 2.5%
+        original_amount = tx.amount
+        refund_amount = usdt_amount(original_amount * REFUND_RATE)
         context.user_data["refund_txid"] = t_id
         context.user_data["refund_amount"] = refund_amount
-        await update.message.reply_text(
-            f"환불 진행. 구매자 지갑 주소?\n(환불 금액: {refund_amount} USDT)\n(취소: /exit)" + command_guide()
-        )
+        await update.message.reply_text(REFUND_WALLET_TEMPLATE.format(amount=format_usdt(refund_amount)))
         return WAITING_FOR_REFUND_WALLET
     except Exception as e:
-        logging.error(f"/refund 오류: {e}")
-        await update.message.reply_text("환불 요청 중 오류.\n" + command_guide())
+        logging.error("/refund 오류: %s", e)
+        await update.message.reply_text("환불 요청 중 오류.\n" + COMMAND_GUIDE)
         return ConversationHandler.END
     finally:
-        session.close()
+        await session.close()
 
 @check_banned
 async def process_refund(update: Update, context: CallbackContext) -> int:
@@ -801,127 +1379,169 @@ async def process_refund(update: Update, context: CallbackContext) -> int:
     buyer_wallet = update.message.text.strip()
     t_id = context.user_data.get("refund_txid")
     refund_amount = context.user_data.get("refund_amount")
+    buyer_id = update.message.from_user.id
+
+    # 송금 전에 환불 상태로 먼저 변경 (중복 환불 / 환불 후 /confirm 방지)
+    session = get_db_session()
     try:
-        result = send_usdt(buyer_wallet, refund_amount, memo=t_id)
-        await update.message.reply_text(
-            f"환불 완료: {refund_amount} USDT → {buyer_wallet}\n거래ID {t_id}\n결과: {result}\n" + command_guide()
-        )
+        if not await transition_status(session, t_id, "deposit_confirmed", "refunded", buyer_id=buyer_id):
+            await update.message.reply_text("이미 처리된 거래입니다.\n" + COMMAND_GUIDE)
+            return ConversationHandler.END
+        await session.commit()
+    except Exception as e:
+        await session.rollback()
+        logging.error("환불 상태 변경 오류: %s", e)
+        await update.message.reply_text("환불 요청 중 오류.\n" + COMMAND_GUIDE)
         return ConversationHandler.END
+    finally:
+        await session.close()
+
+    # 되돌리는 것은 송금이 나가지 않은 게 확실할 때만 (브로드캐스트 이후 되돌리면 환불이 두 번 나갈 수 있음)
+    signed = None
+    try:
+        signed = await sign_usdt_transfer(buyer_wallet, refund_amount, memo=t_id)
+        txn = await signed.broadcast()
     except Exception as e:
-        logging.error(f"환불 송금 오류: {e}")
-        await update.message.reply_text("환불 송금 중 오류.\n" + command_guide())
+        logging.error("환불 송금 오류: %s", e, exc_info=True)
+        if signed is not None and broadcast_outcome_unknown(e):
+            return await report_unconfirmed_refund(update, t_id, signed.txid, buyer_wallet, refund_amount)
+        # 송금 실패 → 다시 환불 가능한 상태로 되돌림
+        session = get_db_session()
+        try:
+            await transition_status(session, t_id, "refunded", "deposit_confirmed", buyer_id=buyer_id)
+            await session.commit()
+        except Exception as e:
+            await session.rollback()
+            logging.error("환불 상태 복구 오류: %s", e)
+        finally:
+            await session.close()
+        await update.message.reply_text("환불 송금 중 오류.\n" + COMMAND_GUIDE)
         return WAITING_FOR_REFUND_WALLET
 
+    try:
+        result = await txn.wait()
+    except Exception as e:
+        logging.error("환불 송금 확인 실패(거래 %s, txid %s): %s", t_id, txn.txid, e, exc_info=True)
+        return await report_unconfirmed_refund(update, t_id, txn.txid, buyer_wallet, refund_amount)
+    await update.message.reply_text(
+        REFUNDED_TEMPLATE.format(amount=format_usdt(refund_amount), wallet=buyer_wallet, t_id=t_id, result=result)
+    )
+    return ConversationHandler.END
+
+# 이미 전송됐을 수 있는 환불 → refunded 유지, 구매자·관리자에게 txid 안내
+async def report_unconfirmed_refund(update: Update, t_id: str, txid: str, wallet: str, amount: Decimal) -> int:
+    amount = format_usdt(amount)
+    notify(
+        ADMIN_TELEGRAM_ID,
+        REFUND_UNCONFIRMED_NOTICE.format(
+            t_id=t_id, buyer_id=update.message.from_user.id, amount=amount, wallet=wallet, txid=txid
+        ),
+    )
+    await update.message.reply_text(
+        REFUND_UNCONFIRMED_TEMPLATE.format(amount=amount, wallet=wallet, t_id=t_id, txid=txid)
+    )
+    return ConversationHandler.END
+
 refund_handler = ConversationHandler(
     entry_points=[CommandHandler("refund", refund_request)],
     states={
-        WAITING_FOR_REFUND_WALLET: [MessageHandler(filters.TEXT & ~filters.COMMAND, process_refund)],
+        WAITING_FOR_REFUND_WALLET: [MessageHandler(TEXT_INPUT, process_refund)],
     },
-    fallbacks=[CommandHandler("exit", exit_to_start), MessageHandler(filters.COMMAND, exit_to_start)],
+    fallbacks=CONVERSATION_FALLBACKS,
 )
 
 # ==============================
 # /rate (거래 종료 후 평점)
 @check_banned
 async def rate_user(update: Update, context: CallbackContext) -> int:
-    args = update.message.text.split(maxsplit=1)
-    if len(args) < 2:
-        await update.message.reply_text("사용법: /rate 거래ID\n" + command_guide())
+    if not context.args:
+        await update.message.reply_text("사용법: /rate 거래ID\n" + COMMAND_GUIDE)
         return WAITING_FOR_RATING
-    t_id = args[1].strip()
+    t_id = context.args[0]
     session = get_db_session()
     try:
-        tx = session.query(Transaction).filter_by(transaction_id=t_id, status="completed").first()
+        tx = await session.scalar(FIND_TRANSACTION_BY_STATUS, {"t_id": t_id, "status": "completed"})
         if not tx:
-            await update.message.reply_text("완료된 거래 아님.\n" + command_guide())
+            await update.message.reply_text("완료된 거래 아님.\n" + COMMAND_GUIDE)
             return WAITING_FOR_RATING
         context.user_data["rating_txid"] = t_id
-        await update.message.reply_text("평점(1~5) 입력.\n" + command_guide())
+        await update.message.reply_text("평점(1~5) 입력.\n" + COMMAND_GUIDE)
         return WAITING_FOR_CONFIRMATION
     except Exception as e:
-        logging.error(f"/rate 오류: {e}")
+        logging.error("/rate 오류: %s", e)
         return WAITING_FOR_RATING
     finally:
-        session.close()
+        await session.close()
 
 @check_banned
 async def save_rating(update: Update, context: CallbackContext) -> int:
+    score_text = update.message.text.strip()
+    # 형식 검사로 잘못된 입력은 예외/DB 세션 없이 바로 다시 물음
+    if not RATING_PATTERN.fullmatch(score_text):
+        await update.message.reply_text("평점은 1~5 숫자로 입력.\n" + COMMAND_GUIDE)
+        return WAITING_FOR_CONFIRMATION
+    score = int(score_text)
     session = get_db_session()
     try:
-        score = int(update.message.text.strip())
-        if score < 1 or score > 5:
-            await update.message.reply_text("평점은 1~5.\n" + command_guide())
-            return WAITING_FOR_CONFIRMATION
         t_id = context.user_data.get("rating_txid")
-        tx = session.query(Transaction).filter_by(transaction_id=t_id, status="completed").first()
+        tx = await session.scalar(FIND_TRANSACTION_BY_STATUS, {"t_id": t_id, "status": "completed"})
         if not tx:
-            await update.message.reply_text("유효한 거래 아님.\n" + command_guide())
+            await update.message.reply_text("유효한 거래 아님.\n" + COMMAND_GUIDE)
             return ConversationHandler.END
 
         target_id = tx.seller_id if update.message.from_user.id == tx.buyer_id else tx.buyer_id
         new_rating = Rating(user_id=target_id, score=score, review="익명")
         session.add(new_rating)
-        session.commit()
-        await update.message.reply_text(f"평점 {score}점 등록!\n" + command_guide())
+        await session.commit()
+        await update.message.reply_text(RATED_TEMPLATE.format(score=score))
         return ConversationHandler.END
-    except ValueError:
-        await update.message.reply_text("숫자로 입력.\n" + command_guide())
-        return WAITING_FOR_CONFIRMATION
     except Exception as e:
-        session.rollback()
-        logging.error(f"/rate 처리 오류: {e}")
+        await session.rollback()
+        logging.error("/rate 처리 오류: %s", e)
         return WAITING_FOR_CONFIRMATION
     finally:
-        session.close()
+        await session.close()
 
 rate_handler = ConversationHandler(
     entry_points=[CommandHandler("rate", rate_user)],
     states={
-        WAITING_FOR_CONFIRMATION: [MessageHandler(filters.TEXT & ~filters.COMMAND, save_rating)],
+        WAITING_FOR_CONFIRMATION: [MessageHandler(TEXT_INPUT, save_rating)],
     },
-    fallbacks=[CommandHandler("exit", exit_to_start), MessageHandler(filters.COMMAND, exit_to_start)],
+    fallbacks=CONVERSATION_FALLBACKS,
 )
 
 # ==============================
 # /chat + relay_message
 @check_banned
 async def start_chat(update: Update, context: CallbackContext) -> None:
-    args = update.message.text.split(maxsplit=1)
-    if len(args) < 2:
-        await update.message.reply_text("사용법: /chat 거래ID\n" + command_guide())
+    if not context.args:
+        await update.message.reply_text("사용법: /chat 거래ID\n" + COMMAND_GUIDE)
         return
-    t_id = args[1].strip()
+    t_id = context.args[0]
     session = get_db_session()
     try:
-        tx = session.query(Transaction).filter_by(transaction_id=t_id).filter(
-            Transaction.status.in_(["accepted", "deposit_confirmed", "deposit_confirmed_over", "completed"])
-        ).first()
+        tx = (await session.execute(CHAT_PARTICIPANTS, {"t_id": t_id})).first()
         if not tx:
-            await update.message.reply_text("유효한 거래 ID 아니거나 상태 불일치.\n" + command_guide())
+            await update.message.reply_text("유효한 거래 ID 아니거나 상태 불일치.\n" + COMMAND_GUIDE)
             return
         user_id = update.message.from_user.id
         if user_id not in [tx.buyer_id, tx.seller_id]:
-            await update.message.reply_text("해당 거래 당사자 아님.\n" + command_guide())
+            await update.message.reply_text("해당 거래 당사자 아님.\n" + COMMAND_GUIDE)
             return
-        active_chats[t_id] = (tx.buyer_id, tx.seller_id)
-        context.user_data["current_chat_tx"] = t_id
-        await update.message.reply_text("채팅 시작. 메시지/파일 전송 시 상대방에게 전달.\n" + command_guide())
+        await open_chat(t_id, user_id, tx.buyer_id, tx.seller_id)
+        await update.message.reply_text("채팅 시작. 메시지/파일 전송 시 상대방에게 전달.\n" + COMMAND_GUIDE)
     except Exception as e:
-        logging.error(f"/chat 오류: {e}")
-        await update.message.reply_text("채팅 시작 오류.\n" + command_guide())
+        logging.error("/chat 오류: %s", e)
+        await update.message.reply_text("채팅 시작 오류.\n" + COMMAND_GUIDE)
     finally:
-        session.close()
+        await session.close()
 
 @check_banned
 async def relay_message(update: Update, context: CallbackContext) -> None:
-    t_id = context.user_data.get("current_chat_tx")
-    if not t_id or t_id not in active_chats:
-        return
-    buyer_id, seller_id = active_chats[t_id]
-    sender = update.message.from_user.id
-    partner = seller_id if sender == buyer_id else buyer_id if sender == seller_id else None
-    if not partner:
+    entry = await get_chat_partner(update.message.from_user.id)
+    if not entry:
         return
+    _, partner = entry
     try:
         if update.message.document:
             file_id = update.message.document.file_id
@@ -934,216 +1554,273 @@ async def relay_message(update: Update, context: CallbackContext) -> None:
             msg_text = update.message.text or "[빈 메시지]"
             await context.bot.send_message(chat_id=partner, text=f"[채팅] {msg_text}")
     except Exception as e:
-        logging.error(f"채팅 메시지 전송 오류: {e}")
+        logging.error("채팅 메시지 전송 오류: %s", e)
 
 # ==============================
 # /off
 @check_banned
 async def off_transaction(update: Update, context: CallbackContext) -> None:
-    args = update.message.text.split(maxsplit=1)
-    if len(args) < 2:
-        await update.message.reply_text("사용법: /off 거래ID\n" + command_guide())
+    if not context.args:
+        await update.message.reply_text("사용법: /off 거래ID\n" + COMMAND_GUIDE)
         return
-    t_id = args[1].strip()
+    t_id = context.args[0]
     session = get_db_session()
     try:
-        tx = session.query(Transaction).filter_by(transaction_id=t_id).first()
-        if not tx:
-            await update.message.reply_text("유효한 거래 ID 아님.\n" + command_guide())
-            return
-        if tx.status not in ["pending", "accepted", "deposit_confirmed", "deposit_confirmed_over"]:
-            await update.message.reply_text("이미 완료되었거나 중단 불가능.\n" + command_guide())
-            return
-        if update.message.from_user.id not in [tx.buyer_id, tx.seller_id]:
-            await update.message.reply_text("해당 거래 당사자 아님.\n" + command_guide())
+        user_id = update.message.from_user.id
+        result = await session.execute(
+            sql_update(Transaction)
+            .where(
+                Transaction.transaction_id == t_id,
+                Transaction.status.in_(CANCELLABLE_STATUSES),
+                or_(Transaction.buyer_id == user_id, Transaction.seller_id == user_id),
+            )
+            .values(status="cancelled")
+            .execution_options(synchronize_session=False)
+        )
+        if result.rowcount == 0:
+            await session.rollback()
+            status = await session.scalar(TRANSACTION_STATUS, {"t_id": t_id})
+            if status is None:
+                await update.message.reply_text("유효한 거래 ID 아님.\n" + COMMAND_GUIDE)
+            elif status not in CANCELLABLE_STATUSES:
+                await update.message.reply_text("이미 완료되었거나 중단 불가능.\n" + COMMAND_GUIDE)
+            else:
+                await update.message.reply_text("해당 거래 당사자 아님.\n" + COMMAND_GUIDE)
             return
-        tx.status = "cancelled"
-        session.commit()
-        if t_id in active_chats:
-            active_chats.pop(t_id)
-        await update.message.reply_text(f"거래 ID {t_id}가 중단됨.\n" + command_guide())
+        await session.commit()
+        await close_chat(t_id)
+        await update.message.reply_text(f"거래 ID {t_id}가 중단됨.\n" + COMMAND_GUIDE)
     except Exception as e:
-        session.rollback()
-        logging.error(f"/off 오류: {e}")
-        await update.message.reply_text("거래 중단 오류.\n" + command_guide())
+        await session.rollback()
+        logging.error("/off 오류: %s", e)
+        await update.message.reply_text("거래 중단 오류.\n" + COMMAND_GUIDE)
     finally:
-        session.close()
+        await session.close()
 
 # ==============================
 # /warexit (관리자)
 @check_banned
 async def warexit_command(update: Update, context: CallbackContext) -> None:
     if update.message.from_user.id != ADMIN_TELEGRAM_ID:
-        await update.message.reply_text("관리자만 가능.\n" + command_guide())
+        await update.message.reply_text("관리자만 가능.\n" + COMMAND_GUIDE)
         return
-    args = update.message.text.split(maxsplit=1)
-    if len(args) < 2:
-        await update.message.reply_text("사용법: /warexit 거래ID\n" + command_guide())
+    if not context.args:
+        await update.message.reply_text("사용법: /warexit 거래ID\n" + COMMAND_GUIDE)
         return
-    t_id = args[1].strip()
+    t_id = context.args[0]
     session = get_db_session()
     try:
-        tx = session.query(Transaction).filter_by(transaction_id=t_id).first()
-        if not tx:
-            await update.message.reply_text("유효한 거래ID 아님.\n" + command_guide())
+        result = await session.execute(
+            sql_update(Transaction)
+            .where(Transaction.transaction_id == t_id)
+            .values(status="cancelled")
+            .execution_options(synchronize_session=False)
+        )
+        if result.rowcount == 0:
+            await session.rollback()
+            await update.message.reply_text("유효한 거래ID 아님.\n" + COMMAND_GUIDE)
             return
-        tx.status = "cancelled"
-        session.commit()
-        if t_id in active_chats:
-            active_chats.pop(t_id)
-        await update.message.reply_text(f"거래 ID {t_id} 강제 종료됨.\n" + command_guide())
+        await session.commit()
+        await close_chat(t_id)
+        await update.message.reply_text(f"거래 ID {t_id} 강제 종료됨.\n" + COMMAND_GUIDE)
     except Exception as e:
-        session.rollback()
-        logging.error(f"/warexit 오류: {e}")
-        await update.message.reply_text("강제 종료 오류.\n" + command_guide())
+        await session.rollback()
+        logging.error("/warexit 오류: %s", e)
+        await update.message.reply_text("강제 종료 오류.\n" + COMMAND_GUIDE)
     finally:
-        session.close()
+        await session.close()
 
 # ==============================
 # /adminsearch (관리자)
 @check_banned
 async def adminsearch_command(update: Update, context: CallbackContext) -> None:
     if update.message.from_user.id != ADMIN_TELEGRAM_ID:
-        await update.message.reply_text("관리자만 가능.\n" + command_guide())
+        await update.message.reply_text("관리자만 가능.\n" + COMMAND_GUIDE)
         return
-    args = update.message.text.split(maxsplit=1)
-    if len(args) < 2:
-        await update.message.reply_text("사용법: /adminsearch 거래ID\n" + command_guide())
+    if not context.args:
+        await update.message.reply_text("사용법: /adminsearch 거래ID\n" + COMMAND_GUIDE)
         return
-    tid = args[1].strip()
+    tid = context.args[0]
     session = get_db_session()
     try:
-        tx = session.query(Transaction).filter_by(transaction_id=tid).first()
+        tx = await session.scalar(FIND_TRANSACTION, {"t_id": tid})
         if not tx:
-            await update.message.reply_text("거래ID 찾을 수 없음.\n" + command_guide())
+            await update.message.reply_text("거래ID 찾을 수 없음.\n" + COMMAND_GUIDE)
             return
         await update.message.reply_text(
             f"거래 ID {tid}\n구매자={tx.buyer_id}\n판매자={tx.seller_id}\n상태={tx.status}"
         )
     except Exception as e:
-        logging.error(f"/adminsearch 오류: {e}")
-        await update.message.reply_text("관리자 검색 오류.\n" + command_guide())
+        logging.error("/adminsearch 오류: %s", e)
+        await update.message.reply_text("관리자 검색 오류.\n" + COMMAND_GUIDE)
     finally:
-        session.close()
+        await session.close()
 
 # ==============================
 # /post (관리자)
 @check_banned
 async def post_command(update: Update, context: CallbackContext) -> None:
     if update.message.from_user.id != ADMIN_TELEGRAM_ID:
-        await update.message.reply_text("관리자만 가능.\n" + command_guide())
+        await update.message.reply_text("관리자만 가능.\n" + COMMAND_GUIDE)
         return
     args = update.message.text.split(maxsplit=1)
     if len(args) < 2:
-        await update.message.reply_text("사용법: /post 내용\n" + command_guide())
+        await update.message.reply_text("사용법: /post 내용\n" + COMMAND_GUIDE)
         return
     notice = args[1].strip()
-    sent_count = 0
+    queued_count = 0
     for user_id in REGISTERED_USERS:
         if user_id in BANNED_USERS:
             continue
-        try:
-            await context.bot.send_message(chat_id=user_id, text=f"[공지]\n{notice}")
-            sent_count += 1
-        except Exception as e:
-            logging.error(f"공지 전송 오류(유저 {user_id}): {e}")
-    await update.message.reply_text(f"공지 전송 완료 ({sent_count}명).\n")
+        notify(user_id, f"[공지]\n{notice}")
+        queued_count += 1
+    await update.message.reply_text(f"공지 전송 시작 ({queued_count}명).\n")
 
 # ==============================
 # /ban, /unban (관리자)
 @check_banned
 async def ban_command(update: Update, context: CallbackContext) -> None:
     if update.message.from_user.id != ADMIN_TELEGRAM_ID:
-        await update.message.reply_text("관리자만 가능.\n" + command_guide())
+        await update.message.reply_text("관리자만 가능.\n" + COMMAND_GUIDE)
         return
-    args = update.message.text.split(maxsplit=1)
-    if len(args) < 2:
-        await update.message.reply_text("사용법: /ban 텔레그램ID\n" + command_guide())
+    if not context.args:
+        await update.message.reply_text("사용법: /ban 텔레그램ID\n" + COMMAND_GUIDE)
         return
     try:
-        ban_id = int(args[1].strip())
+        ban_id = int(context.args[0])
         BANNED_USERS.add(ban_id)
         await update.message.reply_text(f"텔레그램 ID {ban_id} 차단.")
     except ValueError:
-        await update.message.reply_text("유효한 텔레그램 ID.\n" + command_guide())
+        await update.message.reply_text("유효한 텔레그램 ID.\n" + COMMAND_GUIDE)
 
 @check_banned
 async def unban_command(update: Update, context: CallbackContext) -> None:
     if update.message.from_user.id != ADMIN_TELEGRAM_ID:
-        await update.message.reply_text("관리자만 가능.\n" + command_guide())
+        await update.message.reply_text("관리자만 가능.\n" + COMMAND_GUIDE)
         return
-    args = update.message.text.split(maxsplit=1)
-    if len(args) < 2:
-        await update.message.reply_text("사용법: /unban 텔레그램ID\n" + command_guide())
+    if not context.args:
+        await update.message.reply_text("사용법: /unban 텔레그램ID\n" + COMMAND_GUIDE)
         return
     try:
-        unban_id = int(args[1].strip())
+        unban_id = int(context.args[0])
         if unban_id in BANNED_USERS:
             BANNED_USERS.remove(unban_id)
             await update.message.reply_text(f"텔레그램 ID {unban_id} 차단 해제.")
         else:
             await update.message.reply_text(f"ID {unban_id}는 차단 목록에 없음.")
     except ValueError:
-        await update.message.reply_text("유효한 텔레그램 ID.\n" + command_guide())
+        await update.message.reply_text("유효한 텔레그램 ID.\n" + COMMAND_GUIDE)
 
 # ==============================
 # 에러 핸들러
 async def error_handler(update: object, context: CallbackContext) -> None:
     logging.error("오류 발생", exc_info=context.error)
     if update and hasattr(update, "message") and update.message:
-        await update.message.reply_text("오류가 발생했습니다.\n" + command_guide())
+        await update.message.reply_text("오류가 발생했습니다.\n" + COMMAND_GUIDE)
+
+# ==============================
+# 업데이트 동시 처리: 다른 채팅의 업데이트는 동시에, 같은 채팅 안에서는 도착 순서대로
+# (느린 /checkdeposit 이 다른 사용자의 /list 를 막지 않음, 대화 상태 순서는 유지)
+# PTB 의 concurrent_updates 는 슬롯(세마포어)을 먼저 잡은 채 process_update 를 호출 → 같은 채팅에서 줄 선
+# 업데이트들이 슬롯을 점유해 다른 채팅이 굶음. 그래서 PTB 동시 처리는 끄고(순차 fetcher),
+# process_update 는 태스크만 띄운 뒤 바로 반환 — 태스크는 채팅 잠금을 먼저 얻고 나서야 슬롯을 잡음
+CONCURRENT_UPDATES = int(os.getenv("CONCURRENT_UPDATES", "64"))
+update_slots = asyncio.BoundedSemaphore(CONCURRENT_UPDATES)
+chat_locks = weakref.WeakValueDictionary()  # 채팅 ID → Lock (처리 중인 업데이트가 없으면 자동 정리)
+
+class ChatOrderedApplication(Application):
+    async def process_update(self, update: object) -> None:
+        # fetcher 가 도착 순서대로 호출 → 태스크도 그 순서로 시작하고 Lock 은 FIFO 라 채팅 내 순서 유지
+        self.create_task(self.process_update_in_chat_order(update), update=update)
+
+    async def process_update_in_chat_order(self, update: object) -> None:
+        chat = update.effective_chat if isinstance(update, Update) else None
+        if chat is None:
+            async with update_slots:
+                return await super().process_update(update)
+        lock = chat_locks.get(chat.id)
+        if lock is None:
+            lock = chat_locks[chat.id] = asyncio.Lock()
+        async with lock:
+            async with update_slots:
+                await super().process_update(update)
 
 # ==============================
 # 메인 실행부
+# 봇 이벤트 루프 안에서 DB 연결 확인 + 스키마 준비 (asyncpg 연결은 생성된 루프에 묶임)
+async def post_init(app) -> None:
+    try:
+        if INIT_SCHEMA:
+            await init_schema()
+        else:
+            async with get_engine().connect() as conn:
+                await conn.execute(text("SELECT 1"))
+    except Exception as e:
+        logging.error("데이터베이스 연결 오류(Dialect/asyncpg 등): %s", e)
+        raise
+    for _ in range(NOTIFY_WORKERS):
+        notify_tasks.append(asyncio.create_task(notification_worker(app.bot)))
+
+async def post_shutdown(app) -> None:
+    for task in notify_tasks:
+        task.cancel()
+    await get_tron_http().aclose()
+    await get_engine().dispose()
+
 def main():
     if not TELEGRAM_API_KEY:
         logging.error("TELEGRAM_API_KEY가 설정되지 않았습니다!")
         return
-
-    # DB 연결 확인
-    try:
-        from sqlalchemy import text
-        with engine.connect() as conn:
-            conn.execute(text("SELECT 1"))
-    except Exception as e:
-        logging.error("데이터베이스 연결 오류(Dialect/psycopg2 등): %s", e)
+    if not DATABASE_URL:
+        logging.error("DATABASE_URL이 설정되지 않았습니다!")
         return
-
-    # Webhook 해제 (Polling 사용)
-    remove_webhook(TELEGRAM_API_KEY)
+    # run_polling/run_webhook 이 만드는 이벤트 루프가 uvloop 이 되도록 ApplicationBuilder 전에 설치
+    if uvloop is not None:
+        uvloop.install()
 
     # Telegram Application 준비 (JobQueue 관련 코드는 제거됨)
-    app = ApplicationBuilder().token(TELEGRAM_API_KEY).build()
+    # 전송 속도 제한은 rate limiter 가 처리 → 핸들러는 직렬화 없이 바로 반환
+    app = (
+        ApplicationBuilder()
+        .token(TELEGRAM_API_KEY)
+        .application_class(ChatOrderedApplication)
+        .rate_limiter(AIORateLimiter(overall_max_rate=TELEGRAM_MAX_RATE, max_retries=TELEGRAM_MAX_RETRIES))
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
 
     # 에러 핸들러
     app.add_error_handler(error_handler)
 
     # 모든 메시지 핸들러 (등록)
-    app.add_handler(MessageHandler(filters.ALL, register_user), group=0)
-
-    # 주요 명령어 핸들러 등록
-    app.add_handler(CommandHandler("start", start_command))
-    app.add_handler(CommandHandler("list", list_items_command))
-    app.add_handler(CommandHandler("next", next_page))
-    app.add_handler(CommandHandler("prev", prev_page))
-    app.add_handler(CommandHandler("search", search_items_command))
-    app.add_handler(CommandHandler("offer", offer_item))
-    app.add_handler(CommandHandler("accept", accept_transaction))
-    app.add_handler(CommandHandler("refusal", refusal_transaction))
-    app.add_handler(CommandHandler("checkdeposit", check_deposit))
-    app.add_handler(CommandHandler("confirm", confirm_payment))
-    app.add_handler(CommandHandler("off", off_transaction))
-
-    # 관리자 명령어
-    app.add_handler(CommandHandler("warexit", warexit_command))
-    app.add_handler(CommandHandler("adminsearch", adminsearch_command))
-    app.add_handler(CommandHandler("post", post_command))
-    app.add_handler(CommandHandler("ban", ban_command))
-    app.add_handler(CommandHandler("unban", unban_command))
-
-    # 공통 명령어
-    app.add_handler(CommandHandler("chat", start_chat))
-    app.add_handler(CommandHandler("exit", exit_to_start))
+    # 같은 그룹에서는 처음 일치한 핸들러 하나만 실행되므로 별도 그룹(-1)에서 먼저 실행
+    # (group=0 에 두면 filters.ALL 이 모든 메시지를 가져가 명령/대화/중계 핸들러가 실행되지 않음)
+    app.add_handler(MessageHandler(filters.ALL, register_user), group=-1)
+
+    # 주요 명령어 / 관리자 명령어 / 공통 명령어 (dict 하나로 분기)
+    app.add_handler(CommandDispatcherHandler({
+        "start": start_command,
+        "list": list_items_command,
+        "next": next_page,
+        "prev": prev_page,
+        "search": search_items_command,
+        "offer": offer_item,
+        "accept": accept_transaction,
+        "refusal": refusal_transaction,
+        "checkdeposit": check_deposit,
+        "confirm": confirm_payment,
+        "off": off_transaction,
+        # 관리자 명령어
+        "warexit": warexit_command,
+        "adminsearch": adminsearch_command,
+        "post": post_command,
+        "ban": ban_command,
+        "unban": unban_command,
+        # 공통 명령어
+        "chat": start_chat,
+        "exit": exit_to_start,
+    }))
 
     # ConversationHandlers
     app.add_handler(sell_handler)
@@ -1151,11 +1828,33 @@ def main():
     app.add_handler(rate_handler)
     app.add_handler(refund_handler)
 
-    # 파일/메시지 중계 핸들러
-    app.add_handler(MessageHandler(filters.ALL & ~filters.COMMAND, relay_message))
+    # 파일/메시지 중계 핸들러 (채팅 중인 사용자의 일반 메시지만, 수정된 메시지 등은 제외)
+    app.add_handler(MessageHandler(filters.UpdateType.MESSAGE & InActiveChat() & ~filters.COMMAND, relay_message))
+
+    # 봇 실행
+    if WEBHOOK_URL:
+        app.run_webhook(
+            listen="0.0.0.0",
+            port=PORT,
+            url_path=TELEGRAM_API_KEY,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{TELEGRAM_API_KEY}",
+            secret_token=WEBHOOK_SECRET or None,
+            allowed_updates=ALLOWED_UPDATES,
+        )
+    else:
+        # 시작 시 PTB 가 deleteWebhook 을 호출하며 밀린 업데이트도 버림
+        app.run_polling(timeout=POLL_TIMEOUT, allowed_updates=ALLOWED_UPDATES, drop_pending_updates=True)
 
-    # 봇 실행 (Polling 방식)
-    app.run_polling()
+# 배포 시 한 번만 실행: python bot.py init-schema (fly.toml [deploy] release_command)
+# 실패하면 예외로 0 이 아닌 종료 코드 → 배포 중단, 새 버전이 테이블 없이 뜨지 않음
+async def run_init_schema() -> None:
+    try:
+        await init_schema()
+    finally:
+        await get_engine().dispose()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    if sys.argv[1:] == ["init-schema"]:
+        asyncio.run(run_init_schema())
+    else:
+        main()
\ No newline at end of file